@@ -26,13 +26,18 @@ class BayonetConfig(object):
     CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL') or 'redis://127.0.0.1:6379/0'
     CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND') or 'redis://127.0.0.1:6379/1'
     CELERY_TIMEZONE = 'Asia/Shanghai'
-    CELERYBEAT_SCHEDULE = {
-        'urlscan': {
-            'task': 'tools.urlscan.Run.urlscan_main',
-            'schedule': 30.0
-        }
-    }
-    CELERY_INCLUDE = ['tools.urlscan.Run']
+
+
+class WorkQueue:
+    # 任务唤醒通知使用的redis地址，不可用时退化为定时轮询
+    redis_url = os.getenv('QUEUE_REDIS_URL') or 'redis://127.0.0.1:6379/2'
+    idle_timeout = 30  # 无任务时最长等待时间(秒)，收到新任务通知会立即唤醒
+    claim_retries = 5  # 领取任务时被其他进程抢先的最多重试次数
+    # 任务租约时长(秒)，进程领取任务后超过该时间未完成，任务可被其他进程重新领取
+    domain_lease = 7200  # 子域名扫描任务
+    subdomain_lease = 1800  # 端口扫描任务
+    port_lease = 1800  # url探测任务
+    url_lease = 3600  # 爬虫任务
 
 
 class PortScan:
@@ -40,15 +45,26 @@ class PortScan:
     cdn_scan = True
     # shodan查询api
     shodan_api_key = os.getenv('SHODAN_API_KEY') or 'xxxxxxxx'
+    shodan_rate = 1.0  # shodan每秒查询次数，所有端口扫描进程共享(免费API限速1秒1次)
+    shodan_cache_ttl = 7 * 24 * 3600  # shodan查询结果缓存时间(秒)
+    shodan_negative_ttl = 24 * 3600  # shodan无数据结果缓存时间(秒)
     # 是否开启常规端口服务探测
     async_scan = False
-    # 异步端口扫描超时时间
-    async_scan_timeout = 30
-    # 异步协程数
+    # 异步端口扫描单个连接超时时间
+    async_connect_timeout = 3
+    # 异步扫描同时进行的连接数，所有IP共享
     async_scan_threads = 500
     # nmap程序路径地址，可指定具体路径或设置环境变量
     nmap_search_path = ('nmap', '/usr/bin/nmap', '/usr/local/bin/nmap', '/sw/bin/nmap', '/opt/local/bin/nmap')
     port_num = 500  # 超过多少个端口识别为CDN丢弃
+    batch_size = 50  # 每次领取的子域名任务数，同一IP的子域名合并扫描
+    batch_threads = 10  # 同时扫描的IP数，批量识别时为同时进行nmap识别的IP块数
+    discover_chunk = 10  # 批量识别时每发现多少个IP的端口就提交一次nmap识别
+    nmap_bulk = True  # 一批IP按端口集合分组，每组使用一个nmap进程批量识别服务
+    nmap_processes = 4  # 批量识别时每个端口扫描进程同时运行的nmap进程数
+    nmap_timeout = 1800  # 单个nmap进程的运行时间上限(秒)，超时结束进程
+    nmap_group_ports = 100  # 端口集合相近的IP合并扫描时，一组端口并集的上限
+    nmap_group_overlap = 0.8  # 合并扫描时组内每个IP自己的端口占端口并集的最低比例
 
 
 class Oneforall:
@@ -150,15 +166,24 @@ class Oneforall:
     # enable_partial_module = [('modules.search', 'ask')
     #                          ('modules.search', 'baidu')]
     module_thread_timeout = 360.0  # 每个收集模块线程超时时间(默认6分钟)
+    collect_timeout = 900.0  # 子域收集阶段总超时时间(默认15分钟)
+    collect_cancel_grace = 10.0  # 超时取消后等待模块结束的时间
+    # 每个模块类别同时运行的模块数 避免同类搜索引擎互相触发限速
+    collect_category_limits = {'search': 3, 'certificates': 4, 'datasets': 8,
+                               'intelligence': 4, 'check': 6, 'dnsquery': 2,
+                               'crawl': 2}
+    collect_default_limit = 4  # 未配置类别同时运行的模块数
     # 爆破模块设置
     enable_brute_module = False  # 使用爆破模块(默认False)
     enable_dns_resolve = True  # DNS解析子域(默认True)
     enable_http_request = False  # HTTP请求子域(默认True)
     enable_wildcard_check = True  # 开启泛解析检测(默认True)
     enable_wildcard_deal = True  # 开启泛解析处理(默认True)
+    wildcard_probe_times = 3  # 每层爆破域名查询随机子域探测泛解析的次数
     # 爆破时使用的进程数(根据系统中CPU数量情况设置 不宜大于CPU数量 默认为系统中的CPU数量)
     brute_process_num = os.cpu_count()
     brute_coroutine_num = 1024  # 爆破时每个进程下的协程数
+    brute_batch_size = 256  # 爆破时每次分发给解析进程的子域数
     # 爆破所使用的字典路径 默认data/subdomains.txt
     brute_wordlist_path = data_storage_path.joinpath('subnames.txt')
     enable_recursive_brute = False  # 是否使用递归爆破(默认禁用)
@@ -168,6 +193,9 @@ class Oneforall:
     enable_fuzz = False  # 是否使用fuzz模式枚举域名
     fuzz_rule = ''  # fuzz域名的正则 示例：[a-z][0-9] 第一位是字母 第二位是数字
     ips_appear_maximum = 10  # 同一IP集合出现次数超过10认为是泛解析
+    # IP归属地查询缓存设置
+    ip_locate_cache = 65536  # 每个进程缓存的IP数
+    ip_locate_prefix24 = False  # 同一/24网段的IP共用归属地查询结果
     # 代理设置
     enable_proxy = False  # 是否使用代理(全局开关)
     proxy_all_module = False  # 代理所有模块
@@ -184,6 +212,8 @@ class Oneforall:
     request_delay = 1  # 请求时延
     request_timeout = 30  # 请求超时
     request_verify = False  # 请求SSL验证
+    request_pool_hosts = 50  # 每个线程的HTTP会话保持连接的主机数
+    request_pool_size = 10  # 每个线程的HTTP会话对同一主机保持的连接数
     # 禁用安全警告信息
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     # 搜索模块设置
@@ -201,13 +231,20 @@ class Oneforall:
     ]  # 指定查询的DNS域名服务器
     resolver_timeout = 5.0  # 解析超时时间
     resolver_lifetime = 30.0  # 解析存活时间
+    resolver_query_timeout = 2.0  # 异步解析单次查询超时时间
+    resolver_retries = 2  # 异步解析超时或服务器出错时换服务器重试次数
+    resolver_server_limit = 128  # 异步解析每个DNS服务器同时在途的查询数
+    resolver_cache_size = 100000  # 异步解析每个进程缓存的结果数
+    enable_resolve_cache = True  # 子域解析、CNAME查询等结果持久化缓存到本地(默认True)
+    resolve_cache_path = result_save_path.joinpath('resolve_cache.sqlite3')
+    resolve_cache_min_ttl = 60  # 持久化缓存结果的最短缓存时间
     limit_resolve_conn = 500  # 限制同一时间解析的数量(默认500)
     # 请求端口探测设置
     # 你可以在端口列表添加自定义端口
     default_ports = [80]  # 默认使用
     small_ports = [80, 443, 8000, 8080, 8443]
     # 注意：建议大厂的域名尽量不使用大端口范围，因为大厂的子域太多，加上使用大端口范围会导致生成的
-    # 请求上十万，百万，千万级，可能会导致内存不足程序奔溃，另外这样级别的请求量等待时间也是漫长的。
+    # 请求上十万，百万，千万级，这样级别的请求量等待时间是漫长的。
     # OneForAll不是一个端口扫描工具，如果要扫端口建议使用nmap,zmap之类的工具。
     large_ports = [80, 81, 280, 300, 443, 591, 593, 832, 888, 901, 981, 1010, 1080,
                    1100, 1241, 1311, 1352, 1434, 1521, 1527, 1582, 1583, 1944, 2082,
@@ -240,6 +277,8 @@ class Oneforall:
     limit_open_conn = 100  # 默认100
     # 限制同一时间在同一个端点((host, port, is_ssl) 3者都一样的情况)打开的连接数
     limit_per_host = 10  # 0表示不限制,默认10
+    request_read_size = 64 * 1024  # 每个响应最多读取的字节数，只用于提取标题
+    request_save_batch = 500  # 请求结果每攒够多少条写入一次数据库
     subdomains_common = {'i', 'w', 'm', 'en', 'us', 'zh', 'w3', 'app', 'bbs',
                          'web', 'www', 'job', 'docs', 'news', 'blog', 'data',
                          'help', 'live', 'mall', 'blogs', 'files', 'forum',
@@ -250,10 +289,16 @@ class UrlScan:
     timeout = 15  # HTTP访问超时
     success_status_code = [200]  # 该状态码表示为有web应用程序
     failure_status_code = [403, 401]  # 该状态码表示为根目录无应用程序，要进行目录枚举寻找二级应用程序
-    threads = 10  # 多线程数，表示同时处理ports表中的记录
+    threads = 50  # 同时探测的端口数，所有请求共用一个连接池
+    batch_size = 200  # 每次从ports表领取的记录数
+    limit_per_host = 20  # 同一主机(域名或IP)所有端口同时打开的连接数
+    read_size = 256 * 1024  # 每个响应最多读取的字节数
+    port_timeout = 120  # 每个端口探测的总时间(秒)，包含二级目录查找，不含等待主机和全局名额的时间
 
     subdirectory = True  # 开启二级目录查找
-    subdirectory_threads = 10  # 二级目录查找线程数
+    subdirectory_threads = 10  # 每个主机端口同时查找的二级目录数，也是连接池中每个主机端口的连接数
+    subdirectory_timeout = 60  # 每个主机二级目录查找的总时间(秒)
+    subdirectory_hits = 1  # 找到多少个二级目录后停止查找
     subdirectory_path = ['www', 'web', 'admin', 'user', 'login', 'manager', 'root', 'member', 'bbs', 'index', 'system',
                          'cms', 'home', 'main', 'wap', 'app', 'console', 'Web', 'download', 'view', 'public', 'tushu',
                          'sys', 'test', 'api', 'about', 'html', 'site', 'list', 'service', 'help', 'sso', 'mobile',
@@ -1,32 +1,23 @@
-import time
 import multiprocessing
 
+from config import WorkQueue
 from web.models import SrcDomain
-from web import DB
 from web.utils.logs import logger
+from web.utils.workqueue import TaskQueue, DOMAIN_CHANNEL
 from tools.oneforall.oneforall import OneForAll
 
+domain_queue = TaskQueue(SrcDomain, [SrcDomain.flag != '子域名扫描完成'], DOMAIN_CHANNEL, WorkQueue.domain_lease)
+
 def ReadDomain():
-    """读取主域名任务"""
-    results = SrcDomain.query.filter(SrcDomain.flag != '子域名扫描完成').first()
-    DB.session.commit()
+    """领取主域名任务"""
+    results = domain_queue.claim(flag='子域名扫描中')
     if results:
-        results.flag = '子域名扫描中'
-        try:
-            DB.session.commit()
-        except Exception as e:
-            DB.session.rollback()
-            logger.log('ALERT', '修改主域名任务状态SQL错误:%s' % e)
-    return results
+        return results[0]
+    return None
 
 def WriteDomain(results):
     """修改主域名任务状态"""
-    results.flag = '子域名扫描完成'
-    try:
-        DB.session.commit()
-    except Exception as e:
-        DB.session.rollback()
-        logger.log('ALERT', '修改主域名任务状态SQL错误:%s' % e)
+    domain_queue.done([results], flag='子域名扫描完成')
 
 def action(domain):
     """子程序执行"""
@@ -39,9 +30,10 @@ def main():
     while True:
         results = ReadDomain()
         if not results:
-            time.sleep(30)  # 没有任务延迟点时间
+            domain_queue.wait()  # 没有任务等待新任务通知
         else:
-            action(results.domain)
+            with domain_queue.keepalive([results]):
+                action(results.domain)
             WriteDomain(results)
 
 if __name__ == '__main__':
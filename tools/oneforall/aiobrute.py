@@ -12,8 +12,8 @@ import time
 import queue
 import signal
 import asyncio
-import secrets
 import functools
+import itertools
 from multiprocessing import Manager
 import aiomultiprocess as aiomp
 import exrex
@@ -22,58 +22,12 @@ import tqdm
 
 from config import Oneforall
 from tools.oneforall import dbexport
-from tools.oneforall.common import resolve, utils
+from tools.oneforall.common import resolve, utils, wildcard
 from tools.oneforall.common.module import Module
 from tools.oneforall.common.database import Database
 from web.utils.logs import logger
 
 
-def detect_wildcard(domain):
-    """
-    探测域名是否使用泛解析
-
-    :param str domain: 域名
-    :return: 如果没有使用泛解析返回False 反之返回泛解析的IP集合和ttl整型值
-    """
-    logger.log('INFOR', f'正在探测{domain}是否使用泛解析')
-    token = secrets.token_hex(4)
-    random_subdomain = f'{token}.{domain}'
-    try:
-        resolver = resolve.dns_resolver()
-        answers = resolver.query(random_subdomain, 'A')
-    # 如果查询随机域名A记录出错 说明不存在随机子域的A记录 即没有开启泛解析
-    except Exception as e:
-        logger.log('DEBUG', e)
-        logger.log('INFOR', f'{domain}没有使用泛解析')
-        return False, None, None
-    ttl = answers.ttl
-    name = answers.name
-    ips = {item.address for item in answers}
-    logger.log('ALERT', f'{domain}使用了泛解析')
-    logger.log('ALERT', f'{random_subdomain} 解析到域名: {name} '
-                        f'IP: {ips} TTL: {ttl}')
-    return True, ips, ttl
-
-
-def wildcard_by_compare(ips, ttl, wildcard_ips, wildcard_ttl):
-    """
-    通过与泛解析返回的IP集合和返回的TTL值进行对比判断发现的子域是否是泛解析子域
-
-    :param set ips: 子域A记录查询出的IP集合
-    :param int ttl: 子域A记录查询出的TTL整型值
-    :param set wildcard_ips: 泛解析的IP集合
-    :param int wildcard_ttl: 泛解析的TTL整型值
-    :return: 判断结果
-    :rtype bool
-    """
-    # 参考：http://sh3ll.me/archives/201704041222.txt
-    if not ips.issubset(wildcard_ips):
-        return False
-    if ttl != wildcard_ttl and ttl % 60 == 0 and wildcard_ttl % 60 == 0:
-        return False
-    return True
-
-
 def wildcard_by_times(ips, ips_times):
     """
     对ips出现次数进行判断泛解析
@@ -88,18 +42,24 @@ def wildcard_by_times(ips, ips_times):
     return False
 
 
-def gen_fuzz_domains(domain, rule):
-    domains = set()
+def check_fuzz(domain, rule):
+    """
+    检查fuzz位置和规则，随机生成几个域名供用户确认，在开始解析前调用
+
+    :param str domain: 带{fuzz}位置的域名
+    :param str rule: fuzz正则规则
+    :return: fuzz字典大小，检查不通过返回None
+    """
     if '{fuzz}' not in domain:
         logger.log('FATAL', f'没有指定fuzz位置')
-        return domains
+        return None
     if not rule:
         logger.log('FATAL', f'没有指定fuzz规则')
-        return domains
+        return None
     fuzz_count = exrex.count(rule)
     if fuzz_count > 2000000:
         logger.log('FATAL', f'fuzz规则范围太大：{fuzz_count} > 2000000')
-        return domains
+        return None
     logger.log('INFOR', f'fuzz字典大小：{fuzz_count}')
     for i in range(3):
         random_domain = domain.replace('{fuzz}', exrex.getone(rule))
@@ -110,21 +70,70 @@ def gen_fuzz_domains(domain, rule):
     except KeyboardInterrupt:
         logger.log('INFOR', '爆破终止')
         exit(0)
+    return fuzz_count
+
+
+def gen_fuzz_domains(domain, rule, offset=0):
+    """
+    按fuzz正则规则逐个生成爆破域名，调用前须先通过check_fuzz检查
+
+    :param str domain: 带{fuzz}位置的域名
+    :param str rule: fuzz正则规则
+    :param int offset: 跳过规则生成的前offset个结果
+    :return: (位置, 域名)生成器
+    """
     parts = domain.split('{fuzz}')
-    for fuzz in exrex.generate(rule):
-        fuzz_domain = parts[0] + fuzz + parts[1]
-        domains.add(fuzz_domain)
-    return domains
+    # exrex生成的展开结果本身不重复 无需再去重
+    fuzzes = itertools.islice(enumerate(exrex.generate(rule)), offset, None)
+    for position, fuzz in fuzzes:
+        yield position, parts[0] + fuzz + parts[1]
 
 
-def gen_brute_domains(domain, path):
-    domains = set()
+def gen_brute_domains(domain, path, offset=0):
+    """
+    逐行读取字典生成爆破域名
+
+    只记录字典词本身用于去重，不保存生成的完整域名
+
+    :param str domain: 域名
+    :param str path: 字典路径
+    :param int offset: 跳过字典的前offset行
+    :return: (位置, 域名)生成器
+    """
+    seen = set()
+    with open(path, encoding='utf-8', errors='ignore') as file:
+        for position, line in itertools.islice(enumerate(file), offset, None):
+            word = line.strip()
+            if word and word not in seen:
+                seen.add(word)
+                yield position, word + '.' + domain
+
+
+def load_namelist(path):
+    """
+    读取递归爆破字典并去重，递归爆破的所有子域共用
+
+    :param str path: 字典路径
+    :return: 字典列表
+    """
+    words = []
+    seen = set()
     with open(path, encoding='utf-8', errors='ignore') as file:
         for line in file:
-            brute_domain = line.strip() + '.' + domain
-            domains.add(brute_domain)
-    logger.log('INFOR', f'爆破字典大小：{len(domains)}')
-    return domains
+            word = line.strip()
+            if word and word not in seen:
+                seen.add(word)
+                words.append(word)
+    return words
+
+
+def count_lines(path):
+    """统计字典行数"""
+    count = 0
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            count += block.count(b'\n')
+    return count
 
 
 class AIOBrute(Module):
@@ -136,6 +145,7 @@ class AIOBrute(Module):
         python3 aiobrute.py --target ./subdomains.txt run
         python3 aiobrute.py --target example.com --process 4 --coroutine 64 run
         python3 aiobrute.py --target example.com --wordlist subnames.txt run
+        python3 aiobrute.py --target example.com --offset 100000 run
         python3 aiobrute.py --target example.com --recursive True --depth 2 run
         python3 aiobrute.py --target m.{fuzz}.a.bz --fuzz True --rule [a-z] run
 
@@ -147,11 +157,13 @@ class AIOBrute(Module):
         参数format可选格式有'txt', 'rst', 'csv', 'tsv', 'json', 'yaml', 'html',
                           'jira', 'xls', 'xlsx', 'dbf', 'latex', 'ods'
         参数path默认None使用OneForAll结果目录生成路径
+        爆破中断时会输出已完成的字典位置，使用参数offset从该位置继续爆破
 
     :param str target:       单个域名或者每行一个域名的文件路径
     :param int process:      爆破的进程数(默认CPU核心数)
     :param int coroutine:    每个爆破进程下的协程数(默认64)
     :param str wordlist:     指定爆破所使用的字典路径(默认使用config.py配置)
+    :param int offset:       从字典或fuzz规则的指定位置开始爆破(默认0)
     :param bool recursive:   是否使用递归爆破(默认False)
     :param int depth:        递归爆破的深度(默认2)
     :param str namelist:     指定递归爆破所使用的字典路径(默认使用config.py配置)
@@ -165,7 +177,7 @@ class AIOBrute(Module):
     """
 
     def __init__(self, target, process=None, coroutine=None, wordlist=None,
-                 recursive=False, depth=None, namelist=None, fuzz=False,
+                 offset=0, recursive=False, depth=None, namelist=None, fuzz=False,
                  rule=None, export=True, valid=None, format='csv', path=None,
                  show=False):
         Module.__init__(self)
@@ -177,9 +189,11 @@ class AIOBrute(Module):
         self.process = process or Oneforall.brute_process_num
         self.coroutine = coroutine or Oneforall.brute_coroutine_num
         self.wordlist = wordlist or Oneforall.brute_wordlist_path
+        self.offset = offset
         self.recursive_brute = recursive or Oneforall.enable_recursive_brute
         self.recursive_depth = depth or Oneforall.brute_recursive_depth
         self.recursive_namelist = namelist or Oneforall.recursive_namelist_path
+        self.namelist = None  # 递归爆破字典，首次递归爆破时读取
         self.fuzz = fuzz or Oneforall.enable_fuzz
         self.rule = rule or Oneforall.fuzz_rule
         self.export = export
@@ -189,25 +203,33 @@ class AIOBrute(Module):
         self.show = show
         self.nameservers = Oneforall.resolver_nameservers
         self.ips_times = dict()  # IP集合出现次数
-        self.enable_wildcard = False  # 当前域名是否使用泛解析
         self.wildcard_check = Oneforall.enable_wildcard_check
         self.wildcard_deal = Oneforall.enable_wildcard_deal
-        self.wildcard_ips = set()  # 泛解析IP集合
-        self.wildcard_ttl = int()  # 泛解析TTL整型值
+        self.resolver = resolve.StreamResolver(self.process, self.coroutine,
+                                               self.deal_results)
+        # 各层爆破域名的泛解析指纹，解析进程据此丢弃泛解析结果
+        self.fingerprints = self.resolver.fingerprints
 
     def gen_tasks(self, domain):
-        # 如果domain不是self.subdomain，而是self.domain的子域 生成递归爆破字典
-        if self.domain != domain:
-            logger.log('INFOR', f'使用{self.recursive_namelist}字典')
-            domains = gen_brute_domains(domain, self.recursive_namelist)
-        elif self.fuzz and self.rule:  # 开启fuzz模式并指定了fuzz正则规则
+        """
+        生成爆破候选域名
+
+        :param str domain: 爆破的域名
+        :return: (位置, 域名)生成器和预计候选数
+        """
+        if self.fuzz and self.rule:  # 开启fuzz模式并指定了fuzz正则规则
             logger.log('INFOR', f'正在生成{domain}的fuzz字典')
-            domains = gen_fuzz_domains(domain, self.rule)
+            fuzz_count = check_fuzz(domain, self.rule)
+            if fuzz_count is None:
+                return iter(()), 0
+            total = fuzz_count - self.offset
+            domains = gen_fuzz_domains(domain, self.rule, self.offset)
         else:
             logger.log('INFOR', f'使用{self.wordlist}字典')
-            domains = gen_brute_domains(domain, self.wordlist)
-        domains = list(domains)
-        return domains
+            total = count_lines(self.wordlist) - self.offset
+            domains = gen_brute_domains(domain, self.wordlist, self.offset)
+        logger.log('INFOR', f'爆破字典大小：{total}')
+        return domains, max(total, 0)
 
     def deal_results(self, results):
         for result in results:
@@ -217,14 +239,14 @@ class AIOBrute(Module):
             if isinstance(answer, Exception):
                 # logger.log('DEBUG', f'爆破{subdomain}时出错 {str(answers)}')
                 continue
-            name, alias, ips = answer
+            name, alias, ips, ttl = answer
             if name.endswith('.'):
                 name = name[0:-1]
             # 取值 如果是首次出现的IP集合 出现次数先赋值0
             value = self.ips_times.setdefault(str(ips), 0)
             self.ips_times[str(ips)] = value + 1
-            # 目前域名开启了泛解析
-            if self.enable_wildcard and self.wildcard_deal:
+            # 解析进程已丢弃与泛解析指纹相符的结果，这里处理泛解析IP轮换等指纹没有覆盖的情况
+            if wildcard.zone_of(hostname) in self.fingerprints:
                 # 通过对比查询的子域和响应的子域来判断真实子域
                 # 去掉解析到CDN的情况
                 if 'cdn' in name or 'waf' in name:
@@ -240,18 +262,40 @@ class AIOBrute(Module):
                                     f'解析到: {name} IP: {ips}')
                 self.subdomains.add(hostname)
                 self.records[hostname] = str(ips)[1:-1]
-
-    async def main(self, domain, rx_queue):
-        if not self.fuzz:  # fuzz模式不探测域名是否使用泛解析
-            if self.wildcard_check:
-                self.enable_wildcard, self.wildcard_ips, self.wildcard_ttl \
-                    = detect_wildcard(domain)
-        tasks = self.gen_tasks(domain)
+                # 递归爆破时发现的子域不超过递归深度立即爆破其下一层子域
+                # fuzz模式不使用递归爆破
+                if self.recursive_brute and not self.fuzz:
+                    layer_num = hostname.count('.') - self.domain.count('.')
+                    if layer_num < self.recursive_depth:
+                        self.resolver.defer(self.recurse(hostname))
+
+    async def check_wildcard(self, domain):
+        if self.fuzz or not self.wildcard_check:  # fuzz模式不探测域名是否使用泛解析
+            return
+        logger.log('INFOR', f'正在探测{domain}是否使用泛解析')
+        fingerprint = await wildcard.detect(domain)
+        if fingerprint and self.wildcard_deal:
+            self.fingerprints[domain] = fingerprint
+
+    async def recurse(self, subdomain):
+        """
+        把子域的下一层爆破候选追加到正在运行的解析中
+
+        :param str subdomain: 发现的子域
+        """
+        await self.check_wildcard(subdomain)
+        if self.namelist is None:
+            logger.log('INFOR', f'使用{self.recursive_namelist}字典')
+            self.namelist = load_namelist(self.recursive_namelist)
+        logger.log('INFOR', f'开始递归爆破{subdomain}的下一层子域')
+        candidates = ((position, f'{word}.{subdomain}')
+                      for position, word in enumerate(self.namelist))
+        self.resolver.add(candidates, len(self.namelist))
+
+    async def main(self, domain, rx_queue, tasks, total):
+        await self.check_wildcard(domain)
         logger.log('INFOR', f'正在爆破{domain}的域名')
-        # for task in tqdm.tqdm(tasks, total=len(tasks),
-        #                       desc='Progress'):
-        results = await resolve.aio_resolve(tasks, self.process, self.coroutine)
-        self.deal_results(results)
+        await self.resolver.run(tasks, total)
         self.save_json()
         self.gen_result()
         rx_queue.put(self.results)
@@ -262,36 +306,35 @@ class AIOBrute(Module):
             self.domain = self.domains.pop()
             start = time.time()
             db = Database()
-            db.create_table(self.domain)
+            # 单独运行时自行管理扫描记录，由OneForAll调用时结果归入其正在进行的扫描
+            run_id = None
+            if self.export:
+                # 指定offset续爆时沿用中断时未完成的扫描
+                run_id = db.current_run(self.domain) if self.offset else db.begin_run(self.domain)
             if not rx_queue:
                 rx_queue = queue.Queue()
             logger.log('INFOR', f'开始执行{self.source}模块爆破域名{self.domain}')
             logger.log('INFOR', f'使用{self.process}进程乘{self.coroutine}协程')
             # fuzz模式不使用递归爆破
             if self.recursive_brute and not self.fuzz:
-                logger.log('INFOR', f'开始递归爆破{self.domain}的第1层子域')
+                logger.log('INFOR', f'开始递归爆破{self.domain}的子域'
+                                    f'(深度{self.recursive_depth})')
+            # 在事件循环外生成候选，fuzz模式的确认等待不会阻塞解析
+            tasks, total = self.gen_tasks(self.domain)
             loop = asyncio.get_event_loop()
             asyncio.set_event_loop(loop)
-            loop.run_until_complete(self.main(self.domain, rx_queue))
+            try:
+                loop.run_until_complete(self.main(self.domain, rx_queue, tasks, total))
+            except KeyboardInterrupt:
+                logger.log('ALERT', f'爆破{self.domain}中断，可使用参数'
+                                    f'--offset {self.resolver.offset}继续爆破')
+                raise
 
-            # 递归爆破下一层的子域
-            # fuzz模式不使用递归爆破
-            if self.recursive_brute and not self.fuzz:
-                for layer_num in range(1, self.recursive_depth):
-                    # 之前已经做过1层子域爆破 当前实际递归层数是layer+1
-                    logger.log('INFOR', f'开始递归爆破{self.domain}的'
-                                        f'第{layer_num + 1}层子域')
-                    for subdomain in self.subdomains.copy():
-                        # 进行下一层子域爆破的限制条件
-                        if subdomain.count('.') - self.domain.count('.') \
-                                == layer_num:
-                            loop.run_until_complete(self.main(subdomain,
-                                                              rx_queue))
             # 队列不空就一直取数据存数据库
             while not rx_queue.empty():
                 results = rx_queue.get()
                 # 将结果存入数据库中
-                db.save_db(self.domain, results, self.source)
+                db.save_db(self.domain, results, self.source, run_id)
 
             end = time.time()
             self.elapsed = round(end - start, 1)
@@ -306,11 +349,14 @@ class AIOBrute(Module):
                 self.path = Oneforall.result_save_path.joinpath(name)
             # 数据库导出
             if self.export:
+                db.finish_run(self.domain, run_id)
                 dbexport.export(self.domain,
                                 valid=self.valid,
                                 path=self.path,
                                 format=self.format,
-                                show=self.show)
+                                show=self.show,
+                                run_id=run_id)
+            db.close()
 
 
 def do(domain, result):  # 统一入口名字 方便多线程调用
@@ -320,7 +366,7 @@ def do(domain, result):  # 统一入口名字 方便多线程调用
     :param str domain: 域名
     :param result: 结果集队列
     """
-    brute = AIOBrute(domain)
+    brute = AIOBrute(domain, export=False)
     brute.run(result)
 
 
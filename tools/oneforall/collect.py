@@ -1,8 +1,11 @@
 import time
+import queue
 import threading
 import importlib
 from config import Oneforall
 from tools.oneforall import dbexport
+from tools.oneforall.common.database import Database
+from tools.oneforall.common.module import context
 from web.utils.logs import logger
 
 class Collect(object):
@@ -17,6 +20,10 @@ class Collect(object):
         self.path = None
         self.export = export
         self.format = 'csv'
+        self.cancel = threading.Event()  # 取消事件，运行中的模块在下次请求前停止
+        self.deadline = None  # 收集阶段截止时间
+        self.stats = []  # 各模块的执行统计
+        self.running = {}  # 正在运行的模块
 
     def get_mod(self):
         """
@@ -45,7 +52,55 @@ class Collect(object):
         for package, name in self.modules:
             import_object = importlib.import_module('.' + name, 'tools.oneforall.' + package)
             func = getattr(import_object, 'do')
-            self.collect_funcs.append([func, name])
+            category = package.split('.')[-1]
+            self.collect_funcs.append([func, name, category])
+
+    def run_module(self, func, name, category):
+        """
+        运行一个收集模块并记录耗时和发现的子域数
+        """
+        start = time.monotonic()
+        deadline = min(self.deadline, start + Oneforall.module_thread_timeout)
+        self.running[name] = (category, start)
+        context.cancel = self.cancel
+        context.deadline = deadline
+        context.modules = modules = []
+        status = '完成'
+        try:
+            func(self.domain)
+        except Exception as e:
+            status = '出错'
+            logger.log('ERROR', f'{name}模块执行出错:{e}')
+        finally:
+            context.cancel = context.deadline = context.modules = None
+        if status == '完成' and (self.cancel.is_set() or time.monotonic() > deadline):
+            status = '超时'
+        count = sum(len(module.subdomains) for module in modules)
+        self.running.pop(name, None)
+        self.stats.append((name, category, time.monotonic() - start, count, status))
+
+    def worker(self, tasks):
+        """
+        类别工作线程，依次运行该类别的模块，取消后不再开始新模块
+        """
+        while not self.cancel.is_set():
+            try:
+                func, name, category = tasks.get_nowait()
+            except queue.Empty:
+                return
+            self.run_module(func, name, category)
+
+    def summary(self, skipped):
+        """
+        输出各模块的耗时和发现子域数
+        """
+        for name, category in skipped:
+            self.stats.append((name, category, 0.0, 0, '未执行'))
+        logger.log('INFOR', f'{self.domain}子域收集模块执行统计:')
+        for name, category, elapsed, count, status in \
+                sorted(self.stats, key=lambda item: item[2], reverse=True):
+            logger.log('INFOR', f'{name:<20}{category:<14}{elapsed:>7.1f}秒'
+                                f'{count:>7}个 {status}')
 
     def run(self):
         """
@@ -55,35 +110,55 @@ class Collect(object):
         logger.log('INFOR', f'开始收集{self.domain}的子域')
         self.get_mod()
         self.import_func()
+        # 单独运行时自行开始一次扫描，各模块的结果写入最近开始的未完成扫描
+        db = Database()
+        run_id = db.begin_run(self.domain) if self.export else None
 
-        threads = []
-        # 创建多个子域收集线程
+        self.deadline = time.monotonic() + Oneforall.collect_timeout
+        # 按模块类别分组 每个类别限制同时运行的模块数 避免同类搜索引擎互相触发限速
+        groups = {}
         for collect in self.collect_funcs:
-            func_obj, func_name = collect
-            thread = threading.Thread(target=func_obj,
-                                      name=func_name,
-                                      args=(self.domain,),
-                                      daemon=True)
-            threads.append(thread)
-        # 启动所有线程
-        for thread in threads:
-            thread.start()
-        # 等待所有线程完成
-        for thread in threads:
-            # 挨个线程判断超时 最坏情况主线程阻塞时间=线程数*module_thread_timeout
-            # 超时线程将脱离主线程 由于创建线程时已添加守护属于 所有超时线程会随着主线程结束
-            thread.join(Oneforall.module_thread_timeout)
-
+            groups.setdefault(collect[2], queue.Queue()).put(collect)
+        threads = []
+        for category, tasks in groups.items():
+            limit = Oneforall.collect_category_limits.get(category,
+                                                          Oneforall.collect_default_limit)
+            for _ in range(min(limit, tasks.qsize())):
+                thread = threading.Thread(target=self.worker,
+                                          name=f'collect-{category}',
+                                          args=(tasks,),
+                                          daemon=True)
+                threads.append(thread)
+                thread.start()
+        # 所有线程共用一个截止时间 到期后通知模块取消
         for thread in threads:
-            if thread.is_alive():
-                logger.log('ALERT', f'{thread.name}模块线程发生超时')
+            thread.join(max(self.deadline - time.monotonic(), 0))
+        if any(thread.is_alive() for thread in threads):
+            logger.log('ALERT', f'{self.domain}子域收集超时，取消未完成的模块')
+            self.cancel.set()
+            grace = time.monotonic() + Oneforall.collect_cancel_grace
+            for thread in threads:
+                thread.join(max(grace - time.monotonic(), 0))
+        # 取消后仍未结束的模块线程属于守护线程 会随着主线程结束
+        for name, (category, begin) in list(self.running.items()):
+            logger.log('ALERT', f'{name}模块线程发生超时')
+            self.stats.append((name, category, time.monotonic() - begin, 0, '未结束'))
+        skipped = []
+        for tasks in groups.values():
+            while not tasks.empty():
+                func, name, category = tasks.get_nowait()
+                skipped.append((name, category))
+        self.summary(skipped)
 
         # 数据库导出
         if self.export:
             if not self.path:
                 name = f'{self.domain}.{self.format}'
                 self.path = Oneforall.result_save_path.joinpath(name)
-            dbexport.export(self.domain, path=self.path, format=self.format)
+            db.finish_run(self.domain, run_id)
+            dbexport.export(self.domain, path=self.path, format=self.format,
+                            run_id=run_id)
+        db.close()
         end = time.time()
         self.elapsed = round(end - start, 1)
 
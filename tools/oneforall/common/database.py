@@ -3,17 +3,61 @@
 
 """
 SQLite数据库初始化和操作
+
+所有域名的结果存放在同一张results表中，按(domain, run_id, subdomain)建立索引，
+每次扫描对应runs表中的一条记录，去重和新子域标记都在SQL中完成，不再按域名建表和复制整表
 """
 
+import time
+import uuid
+
 import records
 from config import Oneforall
 from records import Connection
 from web.utils.logs import logger
 
+RESULT_COLUMNS = ['id', 'domain', 'run_id', 'url', 'subdomain', 'port', 'ips',
+                  'status', 'reason', 'valid', 'new', 'title', 'banner',
+                  'header', 'response', 'module', 'source', 'elapsed', 'count']
+
+SCHEMA = [
+    'create table if not exists runs ('
+    'run_id text primary key,'
+    'domain text not null,'
+    'start_time float,'
+    'finished int default 0)',
+    'create index if not exists runs_domain on runs (domain, start_time)',
+    'create table if not exists results ('
+    'id integer primary key,'
+    'domain text not null,'
+    'run_id text not null,'
+    'url text,'
+    'subdomain text,'
+    'port int,'
+    'ips text,'
+    'status int,'
+    'reason text,'
+    'valid int,'
+    'new int,'
+    'title text,'
+    'banner text,'
+    'header text,'
+    'response text,'
+    'module text,'
+    'source text,'
+    'elapsed float,'
+    'count int)',
+    'create index if not exists results_run on results (domain, run_id, subdomain)',
+]
+
+INSERT_SQL = f'insert into results ({", ".join(RESULT_COLUMNS)}) ' \
+             f'values ({", ".join(":" + column for column in RESULT_COLUMNS)})'
+
 
 class Database(object):
     def __init__(self, db_path=None):
         self.conn = self.get_conn(db_path)
+        self.init_db()
 
     @staticmethod
     def get_conn(db_path):
@@ -35,182 +79,235 @@ class Database(object):
         logger.log('TRACE', f'使用数据库: {db_path}')
         return db.get_connection()
 
-    def query(self, sql):
+    def init_db(self):
+        """
+        开启WAL模式并创建表结构和索引，WAL模式下批量写入不阻塞其他进程读取
+        """
+        self.query('pragma journal_mode=wal')
+        self.query('pragma synchronous=normal')
+        for sql in SCHEMA:
+            self.query(sql)
+
+    def query(self, sql, **params):
         try:
-            results = self.conn.query(sql)
+            results = self.conn.query(sql, **params)
         except Exception as e:
             logger.log('ERROR', e.args)
         else:
             return results
 
-    def create_table(self, table_name):
+    def begin_run(self, domain):
         """
-        创建表结构
+        开始一次新的扫描
 
-        :param str table_name: 要创建的表名
+        :param str domain: 域名
+        :return: 本次扫描的run_id
         """
-        table_name = table_name.replace('.', '_')
-        if self.exist_table(table_name):
-            logger.log('TRACE', f'已经存在{table_name}表')
-            return
-        logger.log('TRACE', f'正在创建{table_name}表')
-        self.query(f'create table "{table_name}" ('
-                   f'id integer primary key,'
-                   f'url text,'
-                   f'subdomain text,'
-                   f'port int,'
-                   f'ips text,'
-                   f'status int,'
-                   f'reason text,'
-                   f'valid int,'
-                   f'new int,'
-                   f'title text,'
-                   f'banner text,'
-                   f'header text,'
-                   f'response text,'
-                   f'module text,'
-                   f'source text,'
-                   f'elapsed float,'
-                   f'count int)')
-
-    def save_db(self, table_name, results, module_name=None):
-        """
-        将各模块结果存入数据库
-
-        :param str table_name: 表名
+        run_id = uuid.uuid4().hex
+        logger.log('TRACE', f'开始扫描{domain}(run_id: {run_id})')
+        self.query('insert into runs (run_id, domain, start_time, finished) '
+                   'values (:run_id, :domain, :start_time, 0)',
+                   run_id=run_id, domain=domain, start_time=time.time())
+        return run_id
+
+    def current_run(self, domain):
+        """
+        获取域名正在进行的扫描，没有则开始一次新的扫描
+
+        :param str domain: 域名
+        :return: run_id
+        """
+        results = self.query('select run_id from runs where domain = :domain '
+                             'and finished = 0 order by start_time desc limit 1',
+                             domain=domain)
+        run_id = results.scalar() if results is not None else None
+        return run_id or self.begin_run(domain)
+
+    def last_run(self, domain, finished=True):
+        """
+        获取域名最近一次扫描
+
+        :param str domain: 域名
+        :param bool finished: 只查找已完成的扫描
+        :return: run_id，没有扫描记录返回None
+        """
+        where = 'and finished = 1 ' if finished else ''
+        results = self.query(f'select run_id from runs where domain = :domain '
+                             f'{where}order by start_time desc limit 1',
+                             domain=domain)
+        return results.scalar() if results is not None else None
+
+    def finish_run(self, domain, run_id, keep=2):
+        """
+        完成扫描，只保留最近几次扫描的结果
+
+        :param str domain: 域名
+        :param str run_id: 本次扫描
+        :param int keep: 保留的扫描次数
+        """
+        self.query('update runs set finished = 1 where run_id = :run_id',
+                   run_id=run_id)
+        expired = 'select run_id from runs where domain = :domain ' \
+                  'order by start_time desc limit -1 offset :keep'
+        self.query(f'delete from results where domain = :domain '
+                   f'and (run_id in ({expired}) '
+                   f"or run_id in (select run_id || '-staging' from ({expired})))",
+                   domain=domain, keep=keep)
+        self.query(f'delete from runs where run_id in ({expired})',
+                   domain=domain, keep=keep)
+
+    def save_db(self, domain, results, module_name=None, run_id=None):
+        """
+        将各模块结果批量存入数据库
+
+        :param str domain: 域名
         :param list results: 结果列表
         :param str module_name: 模块名
+        :param str run_id: 所属扫描，默认为域名正在进行的扫描
         """
-        logger.log('TRACE', f'正在将{module_name}模块发现{table_name}的子域'
+        logger.log('TRACE', f'正在将{module_name}模块发现{domain}的子域'
                             '结果存入数据库')
-        table_name = table_name.replace('.', '_')
-        if results:
-            try:
-                self.conn.bulk_query(
-                    f'insert into "{table_name}" ('
-                    f'id, url, subdomain, port, ips, status, reason, valid,'
-                    f'new, title, banner, header, response, module, source, '
-                    f'elapsed, count)'
-                    f'values (:id, :url, :subdomain, :port, :ips, :status,'
-                    f':reason, :valid, :new, :title, :banner, :header,'
-                    f':response, :module, :source,:elapsed, :count)',
-                    results)
-            except Exception as e:
-                logger.log('ERROR', e.args)
-
-    def exist_table(self, table_name):
-        """
-        判断是否存在某表
-
-        :param str table_name: 表名
-        :return: 是否存在某表
-        """
-        table_name = table_name.replace('.', '_')
-        logger.log('TRACE', f'正在查询是否存在{table_name}表')
-        results = self.query(f'select count() from sqlite_master '
-                             f'where type = "table" and '
-                             f'name = "{table_name}"')
-        if results.scalar() == 0:
-            return False
-        else:
-            return True
+        if not results:
+            return
+        run_id = run_id or self.current_run(domain)
+        try:
+            self.insert_rows(domain, run_id, results)
+        except Exception as e:
+            logger.log('ERROR', e.args)
 
-    def copy_table(self, table_name, bak_table_name):
+    def insert_rows(self, domain, run_id, results):
+        rows = []
+        for result in results:
+            row = {column: result.get(column) for column in RESULT_COLUMNS}
+            row.update(id=None, domain=domain, run_id=run_id)
+            rows.append(row)
+        if rows:
+            self.conn.bulk_query(INSERT_SQL, rows)
+
+    def begin_staging(self, domain, run_id):
         """
-        复制表创建备份
+        准备本次扫描的暂存结果，清空上次中断时残留的暂存结果
+
+        暂存结果写入单独的run_id，全部写完后再通过replace_results替换本次扫描的结果，
+        写入中途中断时本次扫描原有的结果不受影响
 
-        :param str table_name: 表名
-        :param str bak_table_name: 新表名
+        :param str domain: 域名
+        :param str run_id: 本次扫描
+        :return: 暂存结果使用的run_id
         """
-        table_name = table_name.replace('.', '_')
-        bak_table_name = bak_table_name.replace('.', '_')
-        logger.log('TRACE', f'正在将{table_name}表复制到{bak_table_name}新表')
-        self.query(f'drop table if exists "{bak_table_name}"')
-        self.query(f'create table "{bak_table_name}" '
-                   f'as select * from "{table_name}"')
+        staging = f'{run_id}-staging'
+        self.query('delete from results where domain = :domain '
+                   'and run_id = :run_id', domain=domain, run_id=staging)
+        return staging
 
-    def clear_table(self, table_name):
+    def replace_results(self, domain, run_id, staging):
         """
-        清空表中数据
+        在一个事务中用暂存结果替换本次扫描的结果
 
-        :param str table_name: 表名
+        :param str domain: 域名
+        :param str run_id: 本次扫描
+        :param str staging: 暂存结果使用的run_id
         """
-        table_name = table_name.replace('.', '_')
-        logger.log('TRACE', f'正在清空{table_name}表中的数据')
-        self.query(f'delete from "{table_name}"')
+        logger.log('TRACE', f'正在替换{domain}本次扫描的结果')
+        transaction = self.conn.transaction()
+        try:
+            self.conn.query('delete from results where domain = :domain '
+                            'and run_id = :run_id', domain=domain, run_id=run_id)
+            self.conn.query('update results set run_id = :run_id where domain = :domain '
+                            'and run_id = :staging', domain=domain, run_id=run_id, staging=staging)
+        except Exception as e:
+            transaction.rollback()
+            logger.log('ERROR', e.args)
+        else:
+            transaction.commit()
 
-    def drop_table(self, table_name):
+    def update_resolve(self, results):
         """
-        删除表
+        按id批量更新解析结果
 
-        :param str table_name: 表名
+        :param list results: 结果列表
         """
-        table_name = table_name.replace('.', '_')
-        logger.log('TRACE', f'正在删除{table_name}表')
-        self.query(f'drop table if exists "{table_name}"')
+        rows = [{'id': result.get('id'), 'ips': result.get('ips'),
+                 'reason': result.get('reason'), 'valid': result.get('valid')}
+                for result in results if result.get('id') is not None]
+        if not rows:
+            return
+        try:
+            self.conn.bulk_query('update results set ips = :ips, reason = :reason, '
+                                 'valid = :valid where id = :id', rows)
+        except Exception as e:
+            logger.log('ERROR', e.args)
 
-    def rename_table(self, table_name, new_table_name):
+    def remove_invalid(self, domain, run_id):
         """
-        重命名表名
+        去除本次扫描中的空值或无效子域
 
-        :param str table_name: 表名
-        :param str new_table_name: 新表名
+        :param str domain: 域名
+        :param str run_id: 本次扫描
         """
-        table_name = table_name.replace('.', '_')
-        new_table_name = new_table_name.replace('.', '_')
-        logger.log('TRACE', f'正在将{table_name}表重命名为{table_name}表')
-        self.query(f'alter table "{table_name}" '
-                   f'rename to "{new_table_name}"')
+        logger.log('TRACE', f'正在去除{domain}本次扫描中的无效子域')
+        self.query('delete from results where domain = :domain '
+                   'and run_id = :run_id and (subdomain is null or valid = 0)',
+                   domain=domain, run_id=run_id)
 
-    def deduplicate_subdomain(self, table_name):
+    def deduplicate_subdomain(self, domain, run_id):
         """
-        去重表中的子域
+        去重本次扫描中的子域
 
-        :param str table_name: 表名
+        :param str domain: 域名
+        :param str run_id: 本次扫描
         """
-        table_name = table_name.replace('.', '_')
-        logger.log('TRACE', f'正在去重{table_name}表中的子域')
-        self.query(f'delete from "{table_name}" where '
-                   f'id not in (select min(id) '
-                   f'from "{table_name}" group by subdomain)')
+        logger.log('TRACE', f'正在去重{domain}本次扫描中的子域')
+        self.query('delete from results where domain = :domain '
+                   'and run_id = :run_id and id not in ('
+                   'select min(id) from results where domain = :domain '
+                   'and run_id = :run_id group by subdomain)',
+                   domain=domain, run_id=run_id)
 
-    def remove_invalid(self, table_name):
+    def mark_new(self, domain, run_id, last_run=None):
         """
-        去除表中的空值或无效子域
+        标记本次扫描新发现的子域，上次扫描中没有的子域为新子域
 
-        :param str table_name: 表名
+        :param str domain: 域名
+        :param str run_id: 本次扫描
+        :param str last_run: 上次扫描，为空时所有子域都是新子域
         """
-        table_name = table_name.replace('.', '_')
-        logger.log('TRACE', f'正在去除{table_name}表中的无效子域')
-        self.query(f'delete from "{table_name}" where '
-                   f'subdomain is null or valid == 0')
+        logger.log('TRACE', f'正在标记{domain}新发现的子域')
+        self.query('update results set new = not exists ('
+                   'select 1 from results old where old.domain = :domain '
+                   'and old.run_id = :last_run and old.subdomain = results.subdomain) '
+                   'where domain = :domain and run_id = :run_id',
+                   domain=domain, run_id=run_id, last_run=last_run)
 
-    def get_data(self, table_name):
+    def get_data(self, domain, run_id):
         """
-        获取表中的所有数据
+        获取本次扫描的所有数据
 
-        :param str table_name: 表名
+        :param str domain: 域名
+        :param str run_id: 本次扫描
         """
-        table_name = table_name.replace('.', '_')
-        logger.log('TRACE', f'获取{table_name}表中的所有数据')
-        return self.query(f'select * from "{table_name}"')
+        logger.log('TRACE', f'获取{domain}本次扫描的所有数据')
+        return self.query('select * from results where domain = :domain '
+                          'and run_id = :run_id',
+                          domain=domain, run_id=run_id)
 
-    def export_data(self, table_name, valid):
+    def export_data(self, domain, valid, run_id=None):
         """
-        获取表中的部分数据
+        获取一次扫描的部分数据
 
-        :param str table_name: 表名
+        :param str domain: 域名
         :param any valid: 有效性
+        :param str run_id: 扫描，默认为最近一次完成的扫描
         """
-        table_name = table_name.replace('.', '_')
-        query = f'select id, url, subdomain, port, ips, status, reason,' \
-                f'valid, new, title, banner from "{table_name}"'
+        run_id = run_id or self.last_run(domain)
+        query = 'select id, url, subdomain, port, ips, status, reason,' \
+                'valid, new, title, banner from results ' \
+                'where domain = :domain and run_id = :run_id'
         if valid == 0 or valid == 1:
-            where = f' where valid = {valid}'
+            where = f' and valid = {valid}'
             query += where
-        logger.log('TRACE', f'获取{table_name}表中的所有数据')
-        return self.query(query)
-
+        logger.log('TRACE', f'获取{domain}本次扫描的数据')
+        return self.query(query, domain=domain, run_id=run_id)
 
     def close(self):
         self.conn.close()
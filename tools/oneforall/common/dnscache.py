@@ -0,0 +1,196 @@
+"""
+持久化解析缓存
+
+解析结果和NXDOMAIN、NOANSWER结果按TTL保存在结果目录下的SQLite文件中，各阶段通过本模块查询，
+重复扫描同一域名时只重新查询已过期的记录
+"""
+
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import threading
+
+from config import Oneforall
+from tools.oneforall.common import dnspool
+from web.utils.logs import logger
+
+CACHE_TABLE = '''
+CREATE TABLE IF NOT EXISTS resolve_cache (
+    name TEXT NOT NULL,
+    rdtype TEXT NOT NULL,
+    result TEXT NOT NULL,
+    expire REAL NOT NULL,
+    PRIMARY KEY (name, rdtype)
+) WITHOUT ROWID
+'''
+
+
+def cache_key(name):
+    return name.lower().rstrip('.')
+
+
+def cache_ttl(result):
+    """结果的缓存时间，超时等临时错误不缓存"""
+    if isinstance(result, dnspool.DNSAnswer):
+        ttl = result.ttl
+    elif isinstance(result, dnspool.DNSError) and result.ttl:
+        ttl = result.ttl
+    else:
+        return 0
+    return max(ttl, Oneforall.resolve_cache_min_ttl)
+
+
+def dump(result):
+    if isinstance(result, dnspool.DNSAnswer):
+        return json.dumps(result._asdict())
+    return json.dumps({'error': result.args[0]})
+
+
+def load(name, text, ttl):
+    data = json.loads(text)
+    if 'error' in data:
+        error = dnspool.DNSError(data['error'], name)
+        error.ttl = ttl
+        return error
+    data['ttl'] = ttl
+    return dnspool.DNSAnswer(**data)
+
+
+class ResolveCache(object):
+    """
+    SQLite解析缓存，每个进程的每个线程使用各自的连接
+
+    :param str path: 缓存文件路径
+    """
+
+    def __init__(self, path=None):
+        self.path = str(path or Oneforall.resolve_cache_path)
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        pid, conn = getattr(self.local, 'conn', (None, None))
+        if pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(CACHE_TABLE)
+            self.local.conn = os.getpid(), conn
+        return conn
+
+    def get_many(self, names, rdtype='A'):
+        """
+        批量读取未过期的缓存
+
+        :param list names: 主机名列表
+        :param str rdtype: 记录类型
+        :return: 主机名到解析结果的映射
+        """
+        keys = {cache_key(name): name for name in names}
+        results = {}
+        now = time.time()
+        items = list(keys)
+        try:
+            for i in range(0, len(items), 500):
+                chunk = items[i:i + 500]
+                sql = f'SELECT name, result, expire FROM resolve_cache ' \
+                      f'WHERE rdtype = ? AND name IN ({",".join("?" * len(chunk))})'
+                for key, text, expire in self.conn.execute(sql, [rdtype, *chunk]):
+                    if expire > now:
+                        name = keys[key]
+                        results[name] = load(name, text, int(expire - now))
+        except sqlite3.Error as e:
+            logger.log('ERROR', f'读取解析缓存出错:{e}')
+        return results
+
+    def put_many(self, results, rdtype='A'):
+        """
+        批量写入可缓存的解析结果
+
+        :param results: (主机名, 解析结果)列表
+        :param str rdtype: 记录类型
+        """
+        now = time.time()
+        rows = []
+        for name, result in results:
+            ttl = cache_ttl(result)
+            if ttl:
+                rows.append((cache_key(name), rdtype, dump(result), now + ttl))
+        if not rows:
+            return
+        try:
+            with self.conn:
+                self.conn.execute('DELETE FROM resolve_cache WHERE expire < ?', (now,))
+                self.conn.executemany('INSERT OR REPLACE INTO resolve_cache '
+                                      'VALUES (?, ?, ?, ?)', rows)
+        except sqlite3.Error as e:
+            logger.log('ERROR', f'写入解析缓存出错:{e}')
+
+
+class NullCache(object):
+    """关闭解析缓存时使用"""
+
+    def get_many(self, names, rdtype='A'):
+        return {}
+
+    def put_many(self, results, rdtype='A'):
+        pass
+
+
+_cache = None
+_loop = None
+_lock = threading.Lock()
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResolveCache() if Oneforall.enable_resolve_cache else NullCache()
+    return _cache
+
+
+async def query_many(names, rdtype='A'):
+    """
+    批量查询，先读缓存，未命中或已过期的再异步查询并写回缓存
+
+    :param list names: 主机名列表
+    :param str rdtype: 记录类型
+    :return: 主机名到解析结果或异常的映射
+    """
+    cache = get_cache()
+    results = cache.get_many(names, rdtype)
+    misses = [name for name in set(names) if name not in results]
+    if misses:
+        resolver = dnspool.get_resolver()
+        answers = await asyncio.gather(*[resolver.query(name, rdtype) for name in misses],
+                                       return_exceptions=True)
+        fresh = list(zip(misses, answers))
+        cache.put_many(fresh, rdtype)
+        results.update(fresh)
+    return results
+
+
+def get_loop():
+    """获取后台解析线程的事件循环，供同步代码在线程中查询"""
+    global _loop
+    with _lock:
+        if _loop is None or _loop[0] != os.getpid():
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, daemon=True)
+            thread.start()
+            _loop = os.getpid(), loop
+        return _loop[1]
+
+
+def query(name, rdtype='A'):
+    """
+    同步查询，可在多个线程中同时调用
+
+    :param str name: 主机名
+    :param str rdtype: 记录类型
+    :return: 解析结果或异常
+    """
+    future = asyncio.run_coroutine_threadsafe(query_many([name], rdtype), get_loop())
+    return future.result()[name]
@@ -0,0 +1,329 @@
+"""
+异步DNS解析引擎
+
+直接通过UDP向配置的DNS服务器发送查询，查询轮询分摊到各个服务器，每个服务器限制同时在途的
+查询数，超时或服务器错误时换下一个服务器退避重试，解析结果和不存在的结果都按TTL缓存
+"""
+
+import asyncio
+import collections
+import itertools
+import random
+import time
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+
+from config import Oneforall
+from web.utils.logs import logger
+
+# 解析结果，name为CNAME链最终指向的域名，aliases为CNAME链上的其他域名，ttl取整条链的最小值
+DNSAnswer = collections.namedtuple('DNSAnswer', ['name', 'aliases', 'ips', 'ttl'])
+
+NEGATIVE_TTL = 60  # 响应中没有SOA记录时不存在结果的缓存时间
+MAX_CNAME_CHAIN = 16
+RETRY_RCODES = {dns.rcode.SERVFAIL, dns.rcode.NOTIMP, dns.rcode.REFUSED}
+
+
+class DNSError(Exception):
+    """
+    解析失败，args为(错误类型, 主机名)
+
+    错误类型有NXDOMAIN、NOANSWER、TIMEOUT以及服务器返回的其他响应码
+    """
+    ttl = 0  # NXDOMAIN和NOANSWER结果的缓存时间
+
+
+class DNSProtocol(asyncio.DatagramProtocol):
+    """一个DNS服务器的UDP连接，按查询ID把响应交给等待的查询"""
+
+    def __init__(self):
+        self.transport = None
+        self.waiters = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        waiter = self.waiters.get(int.from_bytes(data[:2], 'big'))
+        if waiter is not None and not waiter.done():
+            waiter.set_result(data)
+
+    def error_received(self, exc):
+        logger.log('TRACE', f'DNS服务器返回错误:{exc}')
+
+    def connection_lost(self, exc):
+        for waiter in self.waiters.values():
+            if not waiter.done():
+                waiter.set_exception(ConnectionError('DNS连接已关闭'))
+
+
+class Nameserver(object):
+    """
+    DNS服务器
+
+    :param str address: 服务器地址
+    :param int limit: 同时在途的查询数
+    """
+
+    def __init__(self, address, limit):
+        self.address = address
+        self.semaphore = asyncio.Semaphore(limit)
+        self.lock = asyncio.Lock()
+        self.protocol = None
+
+    def connected(self):
+        return self.protocol is not None and not self.protocol.transport.is_closing()
+
+    async def connect(self):
+        if self.connected():
+            return self.protocol
+        # 同时到达的查询只创建一个套接字，保证所有套接字都能被close关闭
+        async with self.lock:
+            if not self.connected():
+                loop = asyncio.get_event_loop()
+                _, self.protocol = await loop.create_datagram_endpoint(
+                    DNSProtocol, remote_addr=(self.address, 53))
+        return self.protocol
+
+    def close(self):
+        if self.protocol is not None:
+            transport = self.protocol.transport
+            self.protocol = None
+            try:
+                transport.close()
+            except RuntimeError:  # 事件循环已关闭，套接字在传输对象被回收时关闭
+                pass
+
+    async def exchange(self, request, timeout):
+        """
+        发送一次查询并等待响应
+
+        :param request: dns查询报文
+        :param float timeout: 超时时间
+        :return: 响应报文
+        """
+        async with self.semaphore:
+            protocol = await self.connect()
+            qid = random.getrandbits(16)
+            while qid in protocol.waiters:
+                qid = random.getrandbits(16)
+            waiter = asyncio.get_event_loop().create_future()
+            protocol.waiters[qid] = waiter
+            try:
+                request.id = qid
+                protocol.transport.sendto(request.to_wire())
+                data = await asyncio.wait_for(waiter, timeout)
+            finally:
+                del protocol.waiters[qid]
+        response = dns.message.from_wire(data)
+        # 过期查询的迟到响应可能复用了同一个ID，问题不一致时当作本次查询失败
+        if not response.question or response.question[0] != request.question[0]:
+            raise dns.exception.FormError('响应与查询不匹配')
+        return response
+
+    async def exchange_tcp(self, request, timeout):
+        """
+        通过TCP发送一次查询，UDP响应被截断(TC标志)时使用
+
+        :param request: dns查询报文
+        :param float timeout: 超时时间
+        :return: 响应报文
+        """
+        async with self.semaphore:
+            return await asyncio.wait_for(self.tcp_query(request), timeout)
+
+    async def tcp_query(self, request):
+        reader, writer = await asyncio.open_connection(self.address, 53)
+        try:
+            wire = request.to_wire()
+            # TCP报文前两个字节为报文长度
+            writer.write(len(wire).to_bytes(2, 'big') + wire)
+            await writer.drain()
+            size = int.from_bytes(await reader.readexactly(2), 'big')
+            data = await reader.readexactly(size)
+        finally:
+            writer.close()
+        response = dns.message.from_wire(data)
+        if response.id != request.id or not response.question \
+                or response.question[0] != request.question[0]:
+            raise dns.exception.FormError('响应与查询不匹配')
+        return response
+
+
+def negative_ttl(response):
+    """按响应中SOA记录计算不存在结果的缓存时间"""
+    for rrset in response.authority:
+        if rrset.rdtype == dns.rdatatype.SOA:
+            return min(rrset.ttl, rrset[0].minimum)
+    return NEGATIVE_TTL
+
+
+def negative_result(reason, hostname, response):
+    error = DNSError(reason, hostname)
+    error.ttl = negative_ttl(response)
+    return error, error.ttl
+
+
+def parse_response(hostname, qname, rdtype, response):
+    """
+    解析响应报文
+
+    :return: 解析结果或DNSError，以及缓存时间
+    """
+    rcode = response.rcode()
+    if rcode == dns.rcode.NXDOMAIN:
+        return negative_result('NXDOMAIN', hostname, response)
+    if rcode != dns.rcode.NOERROR:
+        return DNSError(dns.rcode.to_text(rcode), hostname), 0
+    target = qname
+    aliases = []
+    ttls = []
+    for _ in range(MAX_CNAME_CHAIN):
+        rrset = response.get_rrset(response.answer, target,
+                                   dns.rdataclass.IN, dns.rdatatype.CNAME)
+        if rrset is None:
+            break
+        aliases.append(target.to_text(omit_final_dot=True))
+        ttls.append(rrset.ttl)
+        target = rrset[0].target
+    name = target.to_text(omit_final_dot=True)
+    if rdtype == dns.rdatatype.CNAME:
+        if not aliases:
+            return negative_result('NOANSWER', hostname, response)
+        return DNSAnswer(name, aliases, [], min(ttls)), min(ttls)
+    rrset = response.get_rrset(response.answer, target, dns.rdataclass.IN, rdtype)
+    if rrset is None:
+        return negative_result('NOANSWER', hostname, response)
+    ttl = min(ttls + [rrset.ttl])
+    ips = [item.to_text() for item in rrset]
+    return DNSAnswer(name, aliases, ips, ttl), ttl
+
+
+class AsyncResolver(object):
+    """
+    异步DNS解析器，只能在创建它的事件循环中使用
+
+    :param list nameservers: DNS服务器列表
+    :param float timeout: 单次查询超时时间
+    :param int retries: 重试次数
+    :param int limit: 每个服务器同时在途的查询数
+    :param int cache_size: 缓存结果数
+    """
+
+    def __init__(self, nameservers=None, timeout=None, retries=None,
+                 limit=None, cache_size=None):
+        nameservers = nameservers or Oneforall.resolver_nameservers
+        limit = limit or Oneforall.resolver_server_limit
+        self.timeout = timeout or Oneforall.resolver_query_timeout
+        self.retries = Oneforall.resolver_retries if retries is None else retries
+        self.cache_size = Oneforall.resolver_cache_size if cache_size is None else cache_size
+        self.nameservers = [Nameserver(address, limit) for address in nameservers]
+        self.cycle = itertools.cycle(self.nameservers)
+        self.cache = collections.OrderedDict()
+
+    def close(self):
+        for nameserver in self.nameservers:
+            nameserver.close()
+
+    def get_cache(self, key):
+        item = self.cache.get(key)
+        if item is None:
+            return None
+        expire, result = item
+        if expire < time.monotonic():
+            del self.cache[key]
+            return None
+        self.cache.move_to_end(key)
+        return result
+
+    def set_cache(self, key, result, ttl):
+        if ttl <= 0 or not self.cache_size:
+            return
+        self.cache[key] = (time.monotonic() + ttl, result)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    async def query(self, hostname, rdtype='A'):
+        """
+        查询记录
+
+        :param str hostname: 主机名
+        :param str rdtype: 记录类型
+        :return: 解析结果，解析失败抛出DNSError
+        :rtype: DNSAnswer
+        """
+        key = (hostname.lower().rstrip('.'), rdtype)
+        result = self.get_cache(key)
+        if result is None:
+            result = await self.resolve(hostname, rdtype, key)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def resolve(self, hostname, rdtype, key):
+        qname = dns.name.from_text(hostname)
+        rdtype = dns.rdatatype.from_text(rdtype)
+        request = dns.message.make_query(qname, rdtype)
+        error = DNSError('TIMEOUT', hostname)
+        for attempt in range(self.retries + 1):
+            if attempt:
+                # 指数退避并加入抖动，避免大量查询同时重试
+                await asyncio.sleep(0.1 * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            nameserver = next(self.cycle)
+            try:
+                response = await nameserver.exchange(request, self.timeout)
+                if response.flags & dns.flags.TC:
+                    # UDP响应被截断，记录不完整，改用TCP重新查询
+                    response = await nameserver.exchange_tcp(request, self.timeout)
+            except asyncio.TimeoutError:
+                error = DNSError('TIMEOUT', hostname)
+                continue
+            except (OSError, EOFError, dns.exception.DNSException) as e:
+                logger.log('TRACE', f'查询{hostname}时{nameserver.address}出错:{e}')
+                error = DNSError('ERROR', hostname)
+                continue
+            if response.rcode() in RETRY_RCODES:
+                # 服务器错误换下一个服务器重试
+                error = DNSError(dns.rcode.to_text(response.rcode()), hostname)
+                continue
+            result, ttl = parse_response(hostname, qname, rdtype, response)
+            self.set_cache(key, result, ttl)
+            return result
+        return error
+
+
+# 事件循环到解析器的映射，解析器的套接字引用着事件循环，不能用弱引用字典自动清理
+_resolvers = {}
+
+
+def get_resolver():
+    """获取当前事件循环的解析器，每个事件循环各自创建，同时关闭已结束的事件循环的解析器"""
+    loop = asyncio.get_event_loop()
+    resolver = _resolvers.get(loop)
+    if resolver is None:
+        for closed in [key for key in _resolvers if key.is_closed()]:
+            _resolvers.pop(closed).close()
+        resolver = _resolvers[loop] = AsyncResolver()
+    return resolver
+
+
+def close_resolver():
+    """关闭当前事件循环的解析器，事件循环上的解析任务结束后调用，下次查询时重新创建"""
+    resolver = _resolvers.pop(asyncio.get_event_loop(), None)
+    if resolver is not None:
+        resolver.close()
+
+
+def close_resolvers():
+    """关闭本进程所有事件循环的解析器，解析进程退出时调用"""
+    while _resolvers:
+        _resolvers.popitem()[1].close()
@@ -1,8 +1,51 @@
 # coding=utf-8
 import re
+import functools
+import threading
 import tldextract
 from config import Oneforall
 
+DOMAIN_REGEXP = re.compile(r'\b((?=[a-z0-9-]{1,63}\.)(xn--)?[a-z0-9]+(-[a-z0-9]+)*\.)+[a-z]{2,63}\b', re.I)
+
+_extractor = None
+_lock = threading.Lock()
+
+
+def get_extractor():
+    """
+    获取进程内共用的tldextract实例，公共后缀列表只读取解析一次
+    """
+    global _extractor
+    if _extractor is None:
+        with _lock:
+            if _extractor is None:
+                cache_file = Oneforall.data_storage_path.joinpath('public_suffix_list.dat')
+                extractor = tldextract.TLDExtract(cache_file)
+                extractor('example.com')  # 立即加载后缀列表
+                _extractor = extractor
+    return _extractor
+
+
+@functools.lru_cache(maxsize=65536)
+def registered_domain(name):
+    """
+    获取注册域名，结果缓存
+
+    :param str name: 域名
+    :return: 注册域名
+    """
+    return Domain(name).registered()
+
+
+def registered_many(names):
+    """
+    批量获取注册域名，重复的域名只解析一次
+
+    :param names: 域名列表
+    :return: 域名到注册域名的映射
+    """
+    return {name: registered_domain(name) for name in set(names)}
+
 
 class Domain(object):
     """
@@ -12,7 +55,7 @@ class Domain(object):
     """
     def __init__(self, string):
         self.string = str(string)
-        self.regexp = r'\b((?=[a-z0-9-]{1,63}\.)(xn--)?[a-z0-9]+(-[a-z0-9]+)*\.)+[a-z]{2,63}\b'
+        self.regexp = DOMAIN_REGEXP
         self.domain = None
 
     def match(self):
@@ -21,7 +64,7 @@ class Domain(object):
 
         :return: 匹配结果
         """
-        result = re.search(self.regexp, self.string, re.I)
+        result = self.regexp.search(self.string)
         if result:
             return result.group()
         else:
@@ -38,11 +81,9 @@ class Domain(object):
 
         :return: 导出结果
         """
-        extract_cache_file = Oneforall.data_storage_path.joinpath('public_suffix_list.dat')
-        tldext = tldextract.TLDExtract(extract_cache_file)
         result = self.match()
         if result:
-            return tldext(result)
+            return get_extractor()(result)
         else:
             return None
 
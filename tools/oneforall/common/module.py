@@ -4,18 +4,41 @@
 """
 
 import json
-import re
 import threading
 import time
+from http.cookiejar import DefaultCookiePolicy
 
 import requests
+from requests.adapters import HTTPAdapter
 from config import Oneforall
 from web.utils.logs import logger
 from tools.oneforall.common import utils
-from tools.oneforall.common.domain import Domain
+from tools.oneforall.common.domain import registered_domain
 from tools.oneforall.common.database import Database
 
 lock = threading.Lock()
+# 收集调度器在运行模块的线程中设置取消事件、截止时间和模块登记列表
+context = threading.local()
+sessions = threading.local()
+
+
+def get_session():
+    """
+    获取当前线程的HTTP会话
+
+    同一线程中运行的模块共用会话的连接池，分页请求和同一站点的请求复用已建立的连接
+    """
+    session = getattr(sessions, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=Oneforall.request_pool_hosts,
+                              pool_maxsize=Oneforall.request_pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        # 会话不保存响应设置的cookie 避免cookie在模块之间串用 模块仍通过self.cookie传入cookie
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        sessions.session = session
+    return session
 
 
 class Module(object):
@@ -35,6 +58,11 @@ class Module(object):
         self.start = time.time()  # 模块开始执行时间
         self.end = None  # 模块结束执行时间
         self.elapsed = None  # 模块执行耗时
+        self.cancel_event = getattr(context, 'cancel', None)  # 收集调度器的取消事件
+        self.deadline = getattr(context, 'deadline', None)  # 收集调度器给出的截止时间
+        registry = getattr(context, 'modules', None)
+        if registry is not None:
+            registry.append(self)
 
     def check(self, *apis):
         """
@@ -48,6 +76,22 @@ class Module(object):
             return False
         return True
 
+    def cancelled(self):
+        """
+        收集调度器是否要求模块停止，模块请求前检查，被取消后请求直接返回None
+        """
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            return True
+        return self.deadline is not None and time.monotonic() > self.deadline
+
+    def request_timeout(self):
+        """
+        请求超时时间，不超过截止时间
+        """
+        if self.deadline is None:
+            return self.timeout
+        return max(min(self.timeout, self.deadline - time.monotonic()), 1)
+
     def begin(self):
         """
         输出模块开始信息
@@ -76,15 +120,18 @@ class Module(object):
         :param kwargs: 其他参数
         :return: requests响应对象
         """
+        if self.cancelled():
+            logger.log('DEBUG', f'{self.source}模块已取消，跳过请求{url}')
+            return None
         try:
-            resp = requests.head(url,
-                                 params=params,
-                                 cookies=self.cookie,
-                                 headers=self.header,
-                                 proxies=self.proxy,
-                                 timeout=self.timeout,
-                                 verify=self.verify,
-                                 **kwargs)
+            resp = get_session().head(url,
+                                      params=params,
+                                      cookies=self.cookie,
+                                      headers=self.header,
+                                      proxies=self.proxy,
+                                      timeout=self.request_timeout(),
+                                      verify=self.verify,
+                                      **kwargs)
         except Exception as e:
             logger.log('ERROR', e.args)
             return None
@@ -104,15 +151,18 @@ class Module(object):
         :param kwargs: 其他参数
         :return: requests响应对象
         """
+        if self.cancelled():
+            logger.log('DEBUG', f'{self.source}模块已取消，跳过请求{url}')
+            return None
         try:
-            resp = requests.get(url,
-                                params=params,
-                                cookies=self.cookie,
-                                headers=self.header,
-                                proxies=self.proxy,
-                                timeout=self.timeout,
-                                verify=self.verify,
-                                **kwargs)
+            resp = get_session().get(url,
+                                     params=params,
+                                     cookies=self.cookie,
+                                     headers=self.header,
+                                     proxies=self.proxy,
+                                     timeout=self.request_timeout(),
+                                     verify=self.verify,
+                                     **kwargs)
         except Exception as e:
             logger.log('ERROR', e.args)
             return None
@@ -132,15 +182,18 @@ class Module(object):
         :param kwargs: 其他参数
         :return: requests响应对象
         """
+        if self.cancelled():
+            logger.log('DEBUG', f'{self.source}模块已取消，跳过请求{url}')
+            return None
         try:
-            resp = requests.post(url,
-                                 data=data,
-                                 cookies=self.cookie,
-                                 headers=self.header,
-                                 proxies=self.proxy,
-                                 timeout=self.timeout,
-                                 verify=self.verify,
-                                 **kwargs)
+            resp = get_session().post(url,
+                                      data=data,
+                                      cookies=self.cookie,
+                                      headers=self.header,
+                                      proxies=self.proxy,
+                                      timeout=self.request_timeout(),
+                                      verify=self.verify,
+                                      **kwargs)
         except Exception as e:
             logger.log('ERROR', e.args)
             return None
@@ -150,6 +203,31 @@ class Module(object):
             return resp
         return None
 
+    def get_json_items(self, url, params=None, **kwargs):
+        """
+        流式get请求返回json数组的接口，边下载边解析，逐个产出数组元素
+
+        :param str url: 请求地址
+        :param dict params: 请求参数
+        :param kwargs: 其他参数
+        :return: 数组元素生成器
+        """
+        resp = self.get(url, params, check=False, stream=True, **kwargs)
+        if resp is None:
+            return
+        with resp:
+            if resp.status_code != 200:
+                utils.check_response('GET', resp)
+                return
+            try:
+                for item in utils.iter_json_array(resp.iter_content(65536)):
+                    if self.cancelled():
+                        logger.log('DEBUG', f'{self.source}模块已取消，停止读取{url}')
+                        return
+                    yield item
+            except Exception as e:
+                logger.log('ERROR', f'读取{url}响应出错:{e}')
+
     def get_header(self):
         """
         获取请求头
@@ -188,24 +266,14 @@ class Module(object):
         正则匹配出子域
 
         :param str domain: 域名
-        :param str html: 要匹配的html响应体
+        :param html: 要匹配的html响应体
+        :type html: str or bytes
         :param bool distinct: 匹配结果去除
         :return: 匹配出的子域集合或列表
         :rtype: set or list
         """
         logger.log('TRACE', f'正则匹配响应体中的子域')
-        regexp = r'(?:\>|\"|\'|\=|\,)(?:http\:\/\/|https\:\/\/)?' \
-                 r'(?:[a-z0-9](?:[a-z0-9\-]{0,61}[a-z0-9])?\.){0,}' \
-                 + domain.replace('.', r'\.')
-        result = re.findall(regexp, html, re.I)
-        if not result:
-            return set()
-        regexp = r'(?:http://|https://)'
-        deal = map(lambda s: re.sub(regexp, '', s[1:].lower()), result)
-        if distinct:
-            return set(deal)
-        else:
-            return list(deal)
+        return utils.get_matcher(domain, prefix=True).findall(html, distinct)
 
     @staticmethod
     def register(domain):
@@ -215,7 +283,7 @@ class Module(object):
         :param str domain: 域名
         :return: 注册域名
         """
-        return Domain(domain).registered()
+        return registered_domain(domain)
 
     def save_json(self):
         """
@@ -294,7 +362,6 @@ class Module(object):
         """
         lock.acquire()
         db = Database()
-        db.create_table(self.domain)
         db.save_db(self.domain, self.results, self.source)
         db.close()
         lock.release()
@@ -1,13 +1,13 @@
 import asyncio
-import functools
+import codecs
 
 import aiohttp
 import tqdm
 from aiohttp import ClientSession
-from bs4 import BeautifulSoup
 from config import Oneforall
 from tools.oneforall.common import utils
 from web.utils.logs import logger
+from web.utils.webpage import get_title, read_body
 
 
 def get_limit_conn():
@@ -38,8 +38,14 @@ def get_ports(port):
 
 
 def gen_new_datas(datas, ports):
+    """
+    逐个生成请求数据，请求地址在发起请求前才生成，不预先展开所有子域和端口的组合
+
+    :param list datas: 子域数据列表
+    :param set ports: 端口范围
+    :return: 请求数据生成器
+    """
     logger.log('INFOR', f'正在生成请求地址')
-    new_datas = []
     for data in datas:
         valid = data.get('valid')
         if valid is None:  # 子域有效性未知的才进行http请求探测
@@ -47,19 +53,31 @@ def gen_new_datas(datas, ports):
             for port in ports:
                 if str(port).endswith('443'):
                     url = f'https://{subdomain}:{port}'
-                    data['id'] = None
-                    data['url'] = url
-                    data['port'] = port
-                    new_datas.append(data)
-                    data = dict(data)  # 需要生成一个新的字典对象
                 else:
                     url = f'http://{subdomain}:{port}'
-                    data['id'] = None
-                    data['url'] = url
-                    data['port'] = port
-                    new_datas.append(data)
-                    data = dict(data)  # 需要生成一个新的字典对象
-    return new_datas
+                yield dict(data, id=None, url=url, port=port)
+
+
+def decode_body(body, charset=None):
+    """
+    解码响应体
+
+    :param bytes body: 响应体
+    :param str charset: 响应头声明的编码
+    :return: 响应文本
+    """
+    for encoding in ('utf-8', 'gb18030'):
+        # 先尝试用utf-8解码 再尝试用gb18030解码 响应体被截断时忽略末尾不完整的字符
+        decoder = codecs.getincrementaldecoder(encoding)(errors='strict')
+        try:
+            return decoder.decode(body, final=False)
+        except UnicodeError:
+            continue
+    # 最后按响应头声明的编码解码
+    try:
+        return body.decode(charset or 'utf-8', errors='ignore')
+    except LookupError:
+        return body.decode('utf-8', errors='ignore')
 
 
 async def fetch(session, url):
@@ -68,7 +86,7 @@ async def fetch(session, url):
 
     :param session: session对象
     :param str url: url地址
-    :return: 响应对象和响应文本
+    :return: 响应对象和响应文本，响应体最多读取request_read_size字节
     """
     method = Oneforall.request_method.upper()
     timeout = aiohttp.ClientTimeout(total=None,
@@ -82,96 +100,58 @@ async def fetch(session, url):
                                     allow_redirects=Oneforall.allow_redirects,
                                     timeout=timeout,
                                     proxy=Oneforall.aiohttp_proxy) as resp:
-                text = await resp.text()
+                text = ''
         else:
             async with session.get(url,
                                    ssl=Oneforall.verify_ssl,
                                    allow_redirects=Oneforall.allow_redirects,
                                    timeout=timeout,
                                    proxy=Oneforall.aiohttp_proxy) as resp:
-
-                try:
-                    # 先尝试用utf-8解码
-                    text = await resp.text(encoding='utf-8', errors='strict')
-                except UnicodeError:
-                    try:
-                        # 再尝试用gb18030解码
-                        text = await resp.text(encoding='gb18030',
-                                               errors='strict')
-                    except UnicodeError:
-                        # 最后尝试自动解码
-                        text = await resp.text(encoding=None,
-                                               errors='ignore')
+                # 只读取响应体开头部分用于提取标题 截断的连接不放回连接池
+                body = await read_body(resp.content, Oneforall.request_read_size)
+                text = decode_body(body, resp.charset)
         return resp, text
     except Exception as e:
         return e
 
 
-def get_title(markup):
+def deal_result(data, result):
     """
-    获取标题
+    将请求结果更新到请求数据中
 
-    :param markup: html标签
-    :return: 标题
+    :param dict data: 请求数据
+    :param result: 响应对象和响应文本或请求异常
+    :return: 更新后的请求数据
     """
-    soup = BeautifulSoup(markup, 'lxml')
-
-    title = soup.title
-    if title:
-        return title.text
-
-    h1 = soup.h1
-    if h1:
-        return h1.text
-
-    h2 = soup.h2
-    if h2:
-        return h2.text
-
-    h3 = soup.h3
-    if h2:
-        return h3.text
-
-    desc = soup.find('meta', attrs={'name': 'description'})
-    if desc:
-        return desc['content']
-
-    word = soup.find('meta', attrs={'name': 'keywords'})
-    if word:
-        return word['content']
-
-    text = soup.text
-    if len(text) <= 200:
-        return text
-
-    return 'None'
-
-
-def request_callback(future, index, datas):
-    result = future.result()
     if isinstance(result, BaseException):
         logger.log('TRACE', result.args)
         name = utils.get_classname(result)
-        datas[index]['reason'] = name + ' ' + str(result)
-        datas[index]['valid'] = 0
+        data['reason'] = name + ' ' + str(result)
+        data['valid'] = 0
     elif isinstance(result, tuple):
         resp, text = result
-        datas[index]['reason'] = resp.reason
-        datas[index]['status'] = resp.status
+        data['reason'] = resp.reason
+        data['status'] = resp.status
         if resp.status == 400 or resp.status >= 500:
-            datas[index]['valid'] = 0
+            data['valid'] = 0
         else:
-            datas[index]['valid'] = 1
+            data['valid'] = 1
             headers = resp.headers
             banner = str({'Server': headers.get('Server'),
                           'Via': headers.get('Via'),
                           'X-Powered-By': headers.get('X-Powered-By')})
-            datas[index]['banner'] = banner[1:-1]
-            datas[index]['header'] = str(dict(headers))[1:-1]
+            data['banner'] = banner[1:-1]
+            data['header'] = str(dict(headers))[1:-1]
             if isinstance(text, str):
-                title = get_title(text).strip()
-                datas[index]['title'] = utils.remove_string(title)
-                datas[index]['response'] = utils.remove_string(text)
+                title = get_title(text) or 'None'
+                data['title'] = utils.remove_string(title)
+                data['response'] = utils.remove_string(text)
+    return data
+
+
+async def request(session, data):
+    result = await fetch(session, data.get('url'))
+    return deal_result(data, result)
 
 
 def get_connector():
@@ -189,37 +169,59 @@ def get_header():
     return header
 
 
-async def bulk_request(datas, port):
+async def bulk_request(datas, port, callback):
+    """
+    批量请求子域
+
+    请求按窗口逐步发起，同时在途的请求数不超过窗口大小，完成的结果攒够一批就交给callback
+    处理后丢弃，内存占用只与并发数有关
+
+    :param list datas: 子域数据列表
+    :param port: 端口范围
+    :param callback: 结果批处理函数，参数为结果列表
+    :return: 有效结果数
+    """
     ports = get_ports(port)
+    total = sum(1 for data in datas if data.get('valid') is None) * len(ports)
     new_datas = gen_new_datas(datas, ports)
     method = Oneforall.request_method
     logger.log('INFOR', f'使用{method}请求方法')
     logger.log('INFOR', f'正在进行异步子域请求')
     connector = get_connector()
     header = get_header()
+    window = get_limit_conn() * 2
+    batch_size = Oneforall.request_save_batch
+    count = 0
+    results = []
+    bar = tqdm.tqdm(total=total, desc='Progress', ncols=60)
     async with ClientSession(connector=connector, headers=header) as session:
-        tasks = []
-        for i, data in enumerate(new_datas):
-            url = data.get('url')
-            task = asyncio.ensure_future(fetch(session, url))
-            task.add_done_callback(functools.partial(request_callback,
-                                                     index=i,
-                                                     datas=new_datas))
-            tasks.append(task)
-        # 任务列表里有任务不空时才进行解析
-        if tasks:
-            # 等待所有task完成 错误聚合到结果列表里
-            futures = asyncio.as_completed(tasks)
-            for future in tqdm.tqdm(futures,
-                                    total=len(tasks),
-                                    desc='Progress',
-                                    ncols=60):
-                await future
-
-    logger.log('INFOR', f'完成异步进行子域的GET请求')
-    return new_datas
+        pending = set()
+        while True:
+            # 补充请求到窗口大小
+            for data in new_datas:
+                pending.add(asyncio.ensure_future(request(session, data)))
+                if len(pending) >= window:
+                    break
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                count += result.get('valid') == 1
+                results.append(result)
+            bar.update(len(done))
+            if len(results) >= batch_size:
+                callback(results)
+                results = []
+    if results:
+        callback(results)
+    bar.close()
+    logger.log('INFOR', f'完成异步进行子域的{method}请求')
+    return count
 
 
 def run_bulk_query(datas, port):
-    new_datas = asyncio.run(bulk_request(datas, port))
+    new_datas = []
+    asyncio.run(bulk_request(datas, port, new_datas.extend))
     return new_datas
@@ -1,14 +1,17 @@
+import time
 import signal
-import socket
 import asyncio
-import functools
-from multiprocessing import Manager
+import threading
+import collections
+from multiprocessing import util
 
 import tqdm
 import aiomultiprocess as aiomp
+from aiomultiprocess.core import get_context
 from dns.resolver import Resolver
 
 from config import Oneforall
+from tools.oneforall.common import dnscache, dnspool, wildcard
 from web.utils.logs import logger
 
 
@@ -31,13 +34,8 @@ async def aiodns_query_a(hostname):
     :return: 查询结果
     """
     try:
-        loop = asyncio.get_event_loop()
-        socket.setdefaulttimeout(20)
-        # answer = await loop.getaddrinfo(hostname, 80)
-        answer = await loop.run_in_executor(None,
-                                            socket.gethostbyname_ex,
-                                            hostname)
-    except BaseException as e:
+        answer = await dnspool.get_resolver().query(hostname, 'A')
+    except Exception as e:
         logger.log('TRACE', e.args)
         answer = e
     return hostname, answer
@@ -99,35 +97,81 @@ def update_data(data_list, results_dict):
     return data_list
 
 
-def init_worker():
+class ResolveCounter(object):
+    """
+    解析进程的计数器
+
+    计数先在进程内累计，再定时批量写入共享内存，每次查询不产生进程间通信
+
+    :param counts: 共享内存计数数组[完成数, 出错数, 查询总数]
+    """
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.done = 0
+        self.errors = 0
+        self.last = time.monotonic()
+
+    def add(self, error):
+        self.done += 1
+        self.errors += error
+        now = time.monotonic()
+        if self.done >= 256 or now - self.last >= 0.5:
+            with self.counts.get_lock():
+                self.counts[0] += self.done
+                self.counts[1] += self.errors
+            self.done = 0
+            self.errors = 0
+            self.last = now
+
+
+counter = None
+
+
+def init_worker(counts):
+    global counter
     signal.signal(signal.SIGINT, signal.SIG_IGN)
+    counter = ResolveCounter(counts)
+    # 解析进程退出时关闭本进程的DNS套接字
+    util.Finalize(None, dnspool.close_resolvers, exitpriority=10)
+
 
+def query_progress(counts, stop):
+    """
+    定时读取共享计数显示解析进度、每秒查询数和出错率
 
-def query_progress(pr_queue, total):
-    bar = tqdm.tqdm()
-    bar.total = total
-    bar.desc = 'Resolve Progress'
-    bar.ncols = 80
-    bar.smoothing = 0
+    :param counts: 共享内存计数数组[完成数, 出错数, 查询总数]
+    :param stop: 停止事件
+    """
+    bar = tqdm.tqdm(total=counts[2], desc='Resolve Progress', ncols=80, smoothing=0)
+    last_done = 0
+    last_time = time.monotonic()
     while True:
-        done = pr_queue.qsize()
-        bar.n = done
-        bar.update()
-        if done == total:
+        stopped = stop.wait(1)
+        done, errors, total = counts[:]
+        bar.total = total
+        now = time.monotonic()
+        qps = (done - last_done) / (now - last_time)
+        rate = errors / done if done else 0
+        if stopped:
+            bar.total = done
+            bar.update(done - bar.n)
             break
+        bar.set_postfix_str(f'{qps:.0f}qps err:{rate:.1%}', refresh=False)
+        bar.update(done - bar.n)
+        last_done, last_time = done, now
     bar.close()
 
 
-async def aio_query(pr_queue, hostname):
+async def aio_query(hostname):
     """
     异步查询主机名的A记录
 
-    :param pr_queue: 进度队列
     :param str hostname: 主机名
     :return: 查询结果
     """
     results = await aiodns_query_a(hostname)
-    pr_queue.put(1)
+    counter.add(isinstance(results[1], Exception))
     return results
 
 
@@ -140,16 +184,209 @@ async def aio_resolve(subdomain_list, process_num, coroutine_num):
     :param int coroutine_num: 每个解析进程下的协程数
     :return: 解析结果
     """
-    m = Manager()
-    pr_queue = m.Queue()
-    loop = asyncio.get_event_loop()
-    loop.run_in_executor(None, query_progress, pr_queue, len(subdomain_list))
-    wrapped_query = functools.partial(aio_query, pr_queue)
-    async with aiomp.Pool(processes=process_num,
-                          initializer=init_worker,
-                          childconcurrency=coroutine_num) as pool:
-        results = await pool.map(wrapped_query, subdomain_list)
-        return results
+    counts = get_context().Array('q', [0, 0, len(subdomain_list)])
+    stop = threading.Event()
+    progress = threading.Thread(target=query_progress,
+                                args=(counts, stop),
+                                daemon=True)
+    progress.start()
+    start = time.monotonic()
+    try:
+        async with aiomp.Pool(processes=process_num,
+                              initializer=init_worker,
+                              initargs=(counts,),
+                              childconcurrency=coroutine_num) as pool:
+            results = await pool.map(aio_query, subdomain_list)
+        total = len(results)
+        errors = sum(isinstance(answer, Exception) for _, answer in results)
+        # 各进程未达到批量写入条件的计数不再写入，直接以最终结果更新进度
+        counts[:2] = [total, errors]
+    finally:
+        stop.set()
+        progress.join()
+    elapsed = time.monotonic() - start
+    qps = total / elapsed if elapsed else total
+    rate = errors / total if total else 0
+    logger.log('INFOR', f'解析{total}个子域耗时{elapsed:.1f}秒，'
+                        f'平均{qps:.0f}qps，出错率{rate:.1%}')
+    return results
+
+
+async def resolve_batch(names, fingerprints=None):
+    """
+    在解析进程中并发解析一批主机名，只返回解析成功且不是泛解析的结果
+
+    :param list names: 主机名列表
+    :param dict fingerprints: 域名到泛解析指纹的映射
+    :return: 查询数、保留的结果列表和丢弃的泛解析结果数
+    """
+    results = await asyncio.gather(*[aio_query(name) for name in names])
+    found = [result for result in results if not isinstance(result[1], Exception)]
+    kept = wildcard.drop(found, fingerprints)
+    return len(names), kept, len(found) - len(kept)
+
+
+def batched(candidates, size):
+    """
+    把(位置, 主机名)流按批切分
+
+    :return: (批起始位置, 主机名列表)生成器
+    """
+    start = None
+    names = []
+    for position, name in candidates:
+        if not names:
+            start = position
+        names.append(name)
+        if len(names) >= size:
+            yield start, names
+            names = []
+    if names:
+        yield start, names
+
+
+class StreamResolver(object):
+    """
+    流式异步解析
+
+    按批从候选生成器中读取主机名分发给解析进程，在途批数有上限，内存占用与候选数量无关，
+    解析过程中可以继续追加候选生成器，所有候选共用同一个解析进程池
+
+    :param int process_num: 解析进程数
+    :param int coroutine_num: 每个解析进程下的协程数
+    :param callback: 处理每批解析成功结果的回调
+    """
+
+    def __init__(self, process_num, coroutine_num, callback):
+        self.fingerprints = {}  # 域名到泛解析指纹的映射
+        self.process_num = process_num
+        self.batch_size = Oneforall.brute_batch_size
+        self.childconcurrency = coroutine_num // self.batch_size + 1
+        self.window = process_num * self.childconcurrency * 2
+        self.callback = callback
+        self.sources = collections.deque()  # 待分发的(是否是主候选, 批次生成器)
+        self.pending = {}  # 在途批次到主候选位置的映射，追加的候选位置为None
+        self.deferred = set()  # 完成后会追加候选的协程任务
+        self.counts = None
+        self.next_offset = 0
+
+    @property
+    def offset(self):
+        """主候选可以继续解析的位置，该位置之前的主候选都已解析完成"""
+        positions = [position for position in self.pending.values()
+                     if position is not None]
+        if positions:
+            return min(positions)
+        return self.next_offset
+
+    def add(self, candidates, total=None, primary=False):
+        """
+        追加候选生成器，可以在解析过程中调用
+
+        :param candidates: (位置, 主机名)生成器
+        :param int total: 预计查询数，用于显示进度
+        :param bool primary: 是否是记录续解位置的主候选
+        """
+        self.sources.append((primary, batched(candidates, self.batch_size)))
+        if total and self.counts is not None:
+            self.counts[2] += total
+
+    def defer(self, coro):
+        """
+        在解析过程中执行协程，协程完成前解析不会结束
+
+        :param coro: 协程，通常在完成时调用add追加候选
+        """
+        self.deferred.add(asyncio.ensure_future(coro))
+
+    def next_batch(self):
+        while self.sources:
+            primary, batches = self.sources[0]
+            batch = next(batches, None)
+            if batch is not None:
+                return primary, batch
+            self.sources.popleft()
+        return None
+
+    def batch_fingerprints(self, names):
+        """一批主机名所属域名的泛解析指纹"""
+        if not self.fingerprints:
+            return None
+        zones = {wildcard.zone_of(name) for name in names}
+        return {zone: self.fingerprints[zone]
+                for zone in zones if zone in self.fingerprints}
+
+    async def run(self, candidates, total=None):
+        """
+        解析主候选以及解析过程中追加的全部候选
+
+        :param candidates: (位置, 主机名)生成器
+        :param int total: 预计查询数，用于显示进度
+        :return: 查询数和解析成功数
+        """
+        self.sources.clear()
+        self.pending = {}
+        self.deferred = set()
+        self.next_offset = 0
+        self.counts = get_context().Array('q', 3)
+        self.add(candidates, total, primary=True)
+        stop = threading.Event()
+        progress = threading.Thread(target=query_progress,
+                                    args=(self.counts, stop),
+                                    daemon=True)
+        progress.start()
+        start = time.monotonic()
+        queried = found = dropped = 0
+        try:
+            async with aiomp.Pool(processes=self.process_num,
+                                  initializer=init_worker,
+                                  initargs=(self.counts,),
+                                  childconcurrency=self.childconcurrency) as pool:
+                while True:
+                    while len(self.pending) < self.window:
+                        batch = self.next_batch()
+                        if batch is None:
+                            break
+                        primary, (position, names) = batch
+                        args = (names, self.batch_fingerprints(names))
+                        task = asyncio.ensure_future(pool.apply(resolve_batch, args))
+                        self.pending[task] = position if primary else None
+                    if not self.pending and not self.deferred:
+                        break
+                    done, _ = await asyncio.wait(set(self.pending) | self.deferred,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task in self.deferred:
+                            self.deferred.discard(task)
+                            # 追加候选失败(如递归字典无法读取)只跳过这个任务，不中断整个解析
+                            try:
+                                task.result()
+                            except Exception as e:
+                                logger.log('ALERT', f'追加解析候选的任务异常:{e}')
+                            continue
+                        position = self.pending.pop(task)
+                        count, results, wildcards = task.result()
+                        queried += count
+                        found += len(results) + wildcards
+                        dropped += wildcards
+                        if position is not None:
+                            self.next_offset = max(self.next_offset, position + count)
+                        self.callback(results)
+            self.counts[:2] = [queried, queried - found]
+        finally:
+            for task in self.deferred:
+                task.cancel()
+            await asyncio.gather(*self.deferred, return_exceptions=True)
+            # 泛解析检测在当前事件循环中创建的解析器随本轮解析一起关闭
+            dnspool.close_resolver()
+            stop.set()
+            progress.join()
+        elapsed = time.monotonic() - start
+        qps = queried / elapsed if elapsed else queried
+        logger.log('INFOR', f'解析{queried}个子域耗时{elapsed:.1f}秒，'
+                            f'平均{qps:.0f}qps，解析成功{found}个，'
+                            f'其中泛解析{dropped}个')
+        return queried, found
 
 
 async def bulk_resolve(data_list):
@@ -162,9 +399,17 @@ async def bulk_resolve(data_list):
     logger.log('INFOR', '正在异步查询子域的A记录')
     # semaphore = asyncio.Semaphore(config.limit_resolve_conn)
     query_subdomains = filter_subdomain(data_list)
-    process_num = Oneforall.brute_process_num
-    coroutine_num = Oneforall.brute_coroutine_num
-    results = await aio_resolve(query_subdomains, process_num, coroutine_num)
+    cache = dnscache.get_cache()
+    cached = cache.get_many(query_subdomains)
+    logger.log('INFOR', f'待解析子域{len(query_subdomains)}个，命中解析缓存{len(cached)}个')
+    misses = [subdomain for subdomain in query_subdomains if subdomain not in cached]
+    results = list(cached.items())
+    if misses:
+        process_num = Oneforall.brute_process_num
+        coroutine_num = Oneforall.brute_coroutine_num
+        resolved = await aio_resolve(misses, process_num, coroutine_num)
+        cache.put_many(resolved)
+        results.extend(resolved)
     results_dict = convert_results(results)
     data_list = update_data(data_list, results_dict)
     logger.log('INFOR', '完成异步查询子域的A记录')
@@ -1,7 +1,10 @@
 # coding=utf-8
 import re
 import sys
+import json
+import codecs
 import time
+import functools
 import random
 import ipaddress
 import platform
@@ -24,26 +27,108 @@ user_agents = [
     'Mozilla/5.0 (X11; Linux i586; rv:31.0) Gecko/20100101 Firefox/68.0']
 
 
+class SubdomainMatcher(object):
+    """
+    域名的子域匹配器
+
+    预编译str和bytes两种正则，bytes输入直接扫描不必先解码成字符串，原始匹配先去重再转换
+
+    :param str domain: 域名
+    :param bool prefix: 子域前必须是>"'=,字符或http(s)://，用于匹配html响应体
+    """
+
+    def __init__(self, domain, prefix=False):
+        regexp = r'((?:[a-z0-9](?:[a-z0-9\-]{0,61}[a-z0-9])?\.)*' \
+                 + re.escape(domain) + ')'
+        if prefix:
+            regexp = r'[>"\'=,](?:https?://)?' + regexp
+        self.text_regexp = re.compile(regexp, re.I)
+        self.bytes_regexp = re.compile(regexp.encode(), re.I)
+
+    def findall(self, data, distinct=True):
+        """
+        匹配子域
+
+        :param data: 响应文本或响应体
+        :type data: str or bytes
+        :param bool distinct: 结果去重
+        :return: 匹配结果
+        :rtype: set or list
+        """
+        if isinstance(data, (bytes, bytearray)):
+            if distinct:
+                # 边匹配边去重，不保留完整的匹配列表
+                raw = {match.group(1) for match in self.bytes_regexp.finditer(data)}
+                return {match.decode().lower() for match in raw}
+            return [match.decode().lower() for match in self.bytes_regexp.findall(data)]
+        if distinct:
+            raw = {match.group(1) for match in self.text_regexp.finditer(data)}
+            return {match.lower() for match in raw}
+        return [match.lower() for match in self.text_regexp.findall(data)]
+
+
+@functools.lru_cache(maxsize=256)
+def get_matcher(domain, prefix=False):
+    """
+    获取域名的子域匹配器，同一域名只编译一次正则
+    """
+    return SubdomainMatcher(domain, prefix)
+
+
 def match_subdomain(domain, text, distinct=True):
     """
     匹配text中domain的子域名
 
     :param str domain: 域名
-    :param str text: 响应文本
+    :param text: 响应文本或响应体
+    :type text: str or bytes
     :param bool distinct: 结果去重
     :return: 匹配结果
     :rtype: set or list
     """
-    regexp = r'(?:[a-z0-9](?:[a-z0-9\-]{0,61}[a-z0-9])?\.){0,}' \
-             + domain.replace('.', r'\.')
-    result = re.findall(regexp, text, re.I)
-    if not result:
-        return set()
-    deal = map(lambda s: s.lower(), result)
-    if distinct:
-        return set(deal)
-    else:
-        return list(deal)
+    return get_matcher(domain).findall(text, distinct)
+
+
+def iter_json_array(chunks):
+    """
+    增量解析json数组，逐个产出数组元素，内存中只保留未解析完的一个元素
+
+    数组元素须为对象或数组，数字等标量元素可能在分块边界处被截断，
+    响应在数组闭合前中断时抛出ValueError，已产出的元素仍然有效
+
+    :param chunks: 响应体分块迭代器
+    :return: 数组元素生成器
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    buffer = ''
+    pos = 0
+    started = False
+    for chunk in chunks:
+        buffer = buffer[pos:] + text_decoder.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if pos == len(buffer):
+                break
+            if not started:
+                if buffer[pos] != '[':
+                    raise ValueError('响应不是json数组')
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                break  # 元素不完整 等待下一个分块
+            yield item
+    # 正常结束时遇到]已返回，走到这里说明响应在数组闭合前中断
+    if not started:
+        raise ValueError('响应不是json数组')
+    raise ValueError('json数组不完整，响应在]之前中断')
 
 
 def gen_random_ip():
@@ -252,32 +337,6 @@ def check_response(method, resp):
     return False
 
 
-def mark_subdomain(old_data, new_data):
-    """
-    标记新增子域并返回新的数据集
-
-    :param old_data: 之前数据集
-    :param new_data: 现在数据集
-    :return: 已标记的新的数据集
-    """
-    # 第一次收集子域的情况
-    if not old_data:
-        for index, item in enumerate(new_data):
-            item['new'] = 1
-            new_data[index] = item
-        return new_data
-    # 非第一次收集子域的情况
-    old_subdomains = {item.get('subdomain') for item in old_data}
-    for index, item in enumerate(new_data):
-        subdomain = item.get('subdomain')
-        if subdomain in old_subdomains:
-            item['new'] = 0
-        else:
-            item['new'] = 1
-        new_data[index] = item
-    return new_data
-
-
 def remove_string(string):
     # Excel文件中单元格值不能直接存储以下非法字符
     return re.sub(r'[\000-\010]|[\013-\014]|[\016-\037]', r'', string)
@@ -307,12 +366,8 @@ def export_all(format, path, datas):
     path = check_path(path, name, format)
     row_list = list()
     for row in datas:
-        row.pop('header')
-        row.pop('response')
-        row.pop('module')
-        row.pop('source')
-        row.pop('elapsed')
-        row.pop('count')
+        for key in ('header', 'response', 'module', 'source', 'elapsed', 'count'):
+            row.pop(key, None)
         keys = row.keys()
         values = row.values()
         if format in {'xls', 'xlsx'}:
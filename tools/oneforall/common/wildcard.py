@@ -0,0 +1,87 @@
+"""
+泛解析检测
+
+对每一层爆破的域名查询多个随机子域，把解析到的IP集合、TTL和CNAME记录作为泛解析指纹，
+解析进程中与指纹相符的结果直接丢弃，不再传回主进程
+"""
+
+import asyncio
+import secrets
+import collections
+
+from config import Oneforall
+from tools.oneforall.common import dnspool
+from web.utils.logs import logger
+
+# 泛解析指纹，ips为随机子域解析到的IP集合，ttls为TTL集合，names为CNAME指向的域名集合
+Fingerprint = collections.namedtuple('Fingerprint', ['ips', 'ttls', 'names'])
+
+
+def zone_of(hostname):
+    """爆破出的子域所属的爆破域名"""
+    return hostname.split('.', 1)[-1]
+
+
+async def detect(zone, times=None):
+    """
+    探测域名是否使用泛解析
+
+    :param str zone: 爆破的域名
+    :param int times: 查询随机子域的次数
+    :return: 没有使用泛解析返回None，反之返回泛解析指纹
+    """
+    times = times or Oneforall.wildcard_probe_times
+    resolver = dnspool.get_resolver()
+    names = [f'{secrets.token_hex(4)}.{zone}' for _ in range(times)]
+    results = await asyncio.gather(*[resolver.query(name) for name in names],
+                                   return_exceptions=True)
+    answers = [answer for answer in results if isinstance(answer, dnspool.DNSAnswer)]
+    # 随机子域都查询不到A记录 说明没有开启泛解析
+    if not answers:
+        logger.log('INFOR', f'{zone}没有使用泛解析')
+        return None
+    ips = frozenset(ip for answer in answers for ip in answer.ips)
+    ttls = frozenset(answer.ttl for answer in answers)
+    cnames = frozenset(answer.name for answer in answers if answer.aliases)
+    logger.log('ALERT', f'{zone}使用了泛解析 IP: {set(ips)} TTL: {set(ttls)} '
+                        f'CNAME: {set(cnames)}')
+    return Fingerprint(ips, ttls, cnames)
+
+
+def match(answer, fingerprint):
+    """
+    判断解析结果是否是泛解析结果
+
+    :param answer: 子域的解析结果
+    :param fingerprint: 子域所属域名的泛解析指纹
+    :rtype: bool
+    """
+    if answer.aliases and answer.name in fingerprint.names:
+        return True
+    if not fingerprint.ips.issuperset(answer.ips):
+        return False
+    # 参考：http://sh3ll.me/archives/201704041222.txt
+    # 解析到泛解析IP但TTL是与泛解析不同的整分钟数，说明是单独配置的记录
+    if answer.ttl not in fingerprint.ttls and answer.ttl % 60 == 0 \
+            and all(ttl % 60 == 0 for ttl in fingerprint.ttls):
+        return False
+    return True
+
+
+def drop(results, fingerprints):
+    """
+    丢弃解析结果中的泛解析结果
+
+    :param list results: (主机名, 解析结果)列表
+    :param dict fingerprints: 域名到泛解析指纹的映射
+    :return: 保留的结果列表
+    """
+    if not fingerprints:
+        return results
+    kept = []
+    for hostname, answer in results:
+        fingerprint = fingerprints.get(zone_of(hostname))
+        if fingerprint and match(answer, fingerprint):
+            continue
+        kept.append((hostname, answer))
+    return kept
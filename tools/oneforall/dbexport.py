@@ -8,31 +8,27 @@ OneForAll数据库导出模块
 :license: GNU General Public License v3.0, see LICENSE for more details.
 """
 
+import datetime
 import fire
-import ipdb
-from pathlib import Path
 
 from tools.oneforall.common import utils
 from tools.oneforall.common.database import Database
 from web.models import SrcSubDomain, SrcDomain
 from web import DB
-from tools.oneforall.iscdn import iscdn
+from tools.oneforall.iscdn import iscdn_many
+from tools.oneforall.iplocate import locate_many, get_locator
+from web.utils.auxiliary import bulk_insert_ignore
 from web.utils.logs import logger
+from web.utils.workqueue import notify, SUBDOMAIN_CHANNEL
 
-ipdata = Path(__file__).parent.joinpath('ipdata.ipdb')
-if not ipdata.is_file():
-    logger.log('ALERT', f'ipdata.ipdb IP数据库不存在')
-    exit(0)
-else:
-    IPDB = ipdb.City(ipdata.resolve())
-
-def export(table, db=None, valid=None, path=None, format='csv', show=False):
+def export(domain, db=None, valid=None, path=None, format='csv', show=False,
+           run_id=None):
     """
     OneForAll数据库导出模块
 
     Example:
-        python3 dbexport.py --table name --format csv --dir= ./result.csv
-        python3 dbexport.py --db result.db --table name --show False
+        python3 dbexport.py --domain example.com --format csv --dir= ./result.csv
+        python3 dbexport.py --db result.db --domain example.com --show False
 
     Note:
         参数port可选值有'small', 'medium', 'large', 'xlarge'，详见config.py配置
@@ -40,18 +36,19 @@ def export(table, db=None, valid=None, path=None, format='csv', show=False):
                           'jira', 'xls', 'xlsx', 'dbf', 'latex', 'ods'
         参数path默认None使用OneForAll结果目录生成路径
 
-    :param str table:   要导出的表
+    :param str domain:  要导出的域名
     :param str db:      要导出的数据库路径(默认为results/result.sqlite3)
     :param int valid:   导出子域的有效性(默认None)
     :param str format:  导出文件格式(默认csv)
     :param str path:    导出文件路径(默认None)
     :param bool show:   终端显示导出数据(默认False)
+    :param str run_id:  要导出的扫描(默认最近一次完成的扫描)
     """
 
     database = Database(db)
-    rows = database.export_data(table, valid)
+    rows = database.export_data(domain, valid, run_id)
     format = utils.check_format(format, len(rows))
-    path = utils.check_path(path, table, format)
+    path = utils.check_path(path, domain, format)
     if show:
         print(rows.dataset)
     if format == 'txt':
@@ -61,35 +58,27 @@ def export(table, db=None, valid=None, path=None, format='csv', show=False):
     database.close()
     utils.save_data(path, data)
 
-def Warehouse(table, domain, db=None):
+def Warehouse(domain, run_id, db=None):
     logger.log('INFOR', f'开始进行子域名入库')
+    domain_count = SrcDomain.query.filter(SrcDomain.domain == domain).count()
+    # 预先取出该主域名已入库的子域名，已存在的不再入库
+    exists = {row.subdomain for row in DB.session.query(SrcSubDomain.subdomain).filter(SrcSubDomain.domain == domain)}
+    DB.session.commit()
+    if not domain_count:
+        logger.log('DEBUG', f'数据库无已主域名[{domain}]')
+        return None
     database = Database(db)
-    rows = database.export_data(table, valid=None)
+    rows = database.export_data(domain, valid=None, run_id=run_id)
+    records = {}
     for i in rows:
-        if i.ips:
-            ip = i.ips.replace("'", '')
-            if ip.find(', '):
-                ip = ip.split(', ')[0]
-            city = SelectIP(ip)
-            cdn = iscdn(ip)
-            WriteDb(i.subdomain, domain, ip, city, cdn)
+        if i.ips and i.subdomain not in exists and i.subdomain not in records:
+            ip = i.ips.replace("'", '').split(', ')[0]
+            records[i.subdomain] = ip
     database.close()
+    WriteDbBulk(domain, records)
+    notify(SUBDOMAIN_CHANNEL)
     logger.log('INFOR', f'子域名入库完成')
 
-def SelectIP(ip):
-    """查询IP归属地"""
-    try:
-        result = IPDB.find_map(ip, 'CN')
-    except Exception as e:
-        logger.log('DEBUG', f'{ip}查询归属地失败:{e}')
-        return ''
-    else:
-        if result['region_name'] == result['city_name']:
-            ipinfo = result['country_name'] + result['region_name'] + result['isp_domain']
-        else:
-            ipinfo = result['country_name'] + result['region_name'] + result['city_name'] + result['isp_domain']
-        return ipinfo
-
 def WriteDb(subdomain, domain, subdomain_ip, city, cdn):
     """写入数据库"""
     result = SrcSubDomain.query.filter(SrcSubDomain.subdomain == subdomain).count()
@@ -107,6 +96,29 @@ def WriteDb(subdomain, domain, subdomain_ip, city, cdn):
         DB.session.rollback()
         logger.log('ALERT', f'子域名[{subdomain}]入库失败:{e}')
 
+def WriteDbBulk(domain, records):
+    """
+    批量写入子域名，批量判断CDN后多行INSERT入库，已存在的子域名忽略
+
+    :param str domain: 主域名
+    :param dict records: 子域名到IP的映射
+    """
+    if not records:
+        return 0
+    subdomains = list(records)
+    ips = [records[subdomain] for subdomain in subdomains]
+    cdns = iscdn_many(ips)
+    citys = locate_many(ips)
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    rows = []
+    for subdomain, ip, cdn in zip(subdomains, ips, cdns):
+        rows.append({'subdomain': subdomain, 'domain': domain, 'subdomain_ip': ip, 'city': citys[ip],
+                     'cdn': bool(cdn), 'flag': False, 'subdomain_time': now})
+    count = bulk_insert_ignore(SrcSubDomain, rows)
+    logger.log('INFOR', f'[{domain}]新入库子域名{count}个')
+    logger.log('DEBUG', f'IP归属地缓存统计:{get_locator().stats()}')
+    return count
+
 
 if __name__ == '__main__':
     # fire.Fire(export)
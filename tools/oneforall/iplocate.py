@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+
+import ipdb
+from pathlib import Path
+
+from config import Oneforall
+from web import DB
+from web.models import SrcSubDomain
+from web.utils.logs import logger
+
+ipdata = Path(__file__).parent.joinpath('ipdata.ipdb')
+if not ipdata.is_file():
+    logger.log('ALERT', 'ipdata.ipdb IP数据库不存在')
+    exit(0)
+else:
+    IPDB = ipdb.City(ipdata.resolve())
+
+
+class IPLocator(object):
+    """
+    IP归属地查询，带LRU缓存
+
+    多个子域名通常解析到少量IP，查询结果按IP(或IPv4的/24网段)缓存，避免重复查询ipdb和拼接字符串
+
+    :param int maxsize: 缓存条数
+    :param bool prefix24: 同一/24网段共用查询结果
+    """
+
+    def __init__(self, maxsize, prefix24=False):
+        self.maxsize = maxsize
+        self.prefix24 = prefix24
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, ip):
+        if self.prefix24 and ip.count('.') == 3:
+            return ip.rsplit('.', 1)[0]
+        return ip
+
+    def put(self, key, city):
+        with self.lock:
+            self.cache[key] = city
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    @staticmethod
+    def lookup(ip):
+        """查询ipdb"""
+        try:
+            result = IPDB.find_map(ip, 'CN')
+        except Exception as e:
+            logger.log('DEBUG', f'{ip}查询归属地失败:{e}')
+            return ''
+        if result['region_name'] == result['city_name']:
+            return result['country_name'] + result['region_name'] + result['isp_domain']
+        return result['country_name'] + result['region_name'] + result['city_name'] + result['isp_domain']
+
+    def locate(self, ip):
+        """查询单个IP归属地"""
+        key = self.key(ip)
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            self.misses += 1
+        city = self.lookup(ip)
+        self.put(key, city)
+        return city
+
+    def locate_many(self, ips):
+        """
+        批量查询IP归属地
+
+        :param ips: IP列表
+        :return: IP到归属地的映射
+        """
+        return {ip: self.locate(ip) for ip in set(ips)}
+
+    def warm(self, records):
+        """用已知的(IP, 归属地)预热缓存"""
+        for ip, city in records:
+            if ip and city:
+                self.put(self.key(ip), city)
+
+    def stats(self):
+        total = self.hits + self.misses
+        rate = round(self.hits / total * 100, 1) if total else 0
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.cache), 'rate': rate}
+
+
+locator = None
+
+
+def get_locator():
+    """获取进程内共享的归属地查询对象，首次使用时用数据库中已入库子域名的归属地预热"""
+    global locator
+    if locator is None:
+        locator = IPLocator(Oneforall.ip_locate_cache, Oneforall.ip_locate_prefix24)
+        try:
+            records = DB.session.query(SrcSubDomain.subdomain_ip, SrcSubDomain.city).distinct() \
+                .limit(Oneforall.ip_locate_cache).all()
+            DB.session.commit()
+        except Exception as e:
+            DB.session.rollback()
+            logger.log('DEBUG', f'预热IP归属地缓存失败:{e}')
+        else:
+            locator.warm(records)
+    return locator
+
+
+def locate(ip):
+    return get_locator().locate(ip)
+
+
+def locate_many(ips):
+    return get_locator().locate_many(ips)
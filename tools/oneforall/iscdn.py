@@ -1,8 +1,16 @@
 
+import bisect
 import ipaddress
+import socket
+import threading
 import geoip2.database
 from pathlib import Path
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 cdns = [
     '223.99.255.0/24', '71.152.0.0/17', '219.153.73.0/24', '125.39.46.0/24', '190.93.240.0/20', '14.0.113.0/24',
     '14.0.47.0/24', '113.20.148.0/22', '103.75.201.0/24', '1.32.239.0/24', '101.79.239.0/24', '52.46.0.0/18',
@@ -112,25 +120,128 @@ ASNS = [
 
 ASNdata = Path(__file__).parent.joinpath('GeoLite2-ASN.mmdb')
 
-def iscdn(ip):
-    result = False
-    try:
-        for cdn in cdns:
-            if ipaddress.ip_address(ip) in ipaddress.ip_network(cdn):
-                result = True
-                return result
-    except Exception:
-        pass
-
-    try:
-        with geoip2.database.Reader(ASNdata.resolve()) as reader:
+
+class CdnClassifier(object):
+    """
+    CDN判断器
+
+    CDN网段合并为有序整数区间，通过二分查找判断IP是否属于CDN网段；ASN数据库只打开一次，
+    整个进程复用
+
+    :param list networks: CDN网段列表
+    :param list asns: CDN的ASN列表
+    :param asn_path: GeoLite2 ASN数据库路径
+    """
+
+    def __init__(self, networks, asns, asn_path):
+        intervals = []
+        for network in networks:
+            network = ipaddress.ip_network(network)
+            intervals.append((int(network.network_address), int(network.broadcast_address)))
+        intervals.sort()
+        merged = []
+        for start, end in intervals:  # 合并重叠或相邻的网段
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = [start for start, end in merged]
+        self.ends = [end for start, end in merged]
+        self.asns = {int(asn) for asn in asns}
+        self.asn_path = asn_path
+        self.reader = None
+        self.lock = threading.Lock()
+
+    def get_reader(self):
+        """获取ASN数据库读取对象，数据库不存在返回None"""
+        if self.reader is None:
+            with self.lock:
+                if self.reader is None:
+                    try:
+                        self.reader = geoip2.database.Reader(str(self.asn_path.resolve()))
+                    except Exception:
+                        self.reader = False
+        return self.reader or None
+
+    def in_networks(self, value):
+        """判断整数形式的IPv4地址是否在CDN网段中"""
+        index = bisect.bisect_right(self.starts, value) - 1
+        return index >= 0 and value <= self.ends[index]
+
+    def in_asns(self, ip):
+        """判断IP所属ASN是否为CDN"""
+        reader = self.get_reader()
+        if not reader:
+            return False
+        try:
             response = reader.asn(ip)
-            for i in ASNS:
-                if response.autonomous_system_number == int(i):
-                    result = True
-    except Exception:
-        pass
-    return result
+        except Exception:
+            return False
+        return response.autonomous_system_number in self.asns
+
+    def check(self, ip):
+        """判断单个IP是否为CDN"""
+        try:
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET, ip), 'big')
+        except (OSError, TypeError):
+            try:
+                ip = str(ipaddress.ip_address(ip))  # IPv6只通过ASN判断
+            except ValueError:
+                return False
+        else:
+            if self.in_networks(value):
+                return True
+        return self.in_asns(ip)
+
+    def check_many(self, ips):
+        """
+        批量判断IP是否为CDN
+
+        重复IP只判断一次；NumPy数组输入时网段判断向量化，不在CDN网段的IP按/24网段去重后再查ASN，
+        公网路由宣告的最小前缀为/24，同一/24网段属于同一ASN
+
+        :param ips: IP字符串列表，或整数形式IPv4地址的NumPy数组
+        :return: 与输入顺序一致的判断结果列表(NumPy数组输入时返回布尔数组)
+        """
+        if numpy is not None and isinstance(ips, numpy.ndarray) and ips.dtype.kind in 'iu':
+            values = ips.astype(numpy.int64)
+            starts = numpy.asarray(self.starts, dtype=numpy.int64)
+            ends = numpy.asarray(self.ends, dtype=numpy.int64)
+            index = numpy.searchsorted(starts, values, side='right') - 1
+            result = (index >= 0) & (values <= ends[numpy.maximum(index, 0)])
+            misses = numpy.flatnonzero(~result)
+            if misses.size:
+                _, first, inverse = numpy.unique(values[misses] >> 8, return_index=True, return_inverse=True)
+                found = numpy.array([self.in_asns(str(ipaddress.IPv4Address(int(values[misses[i]]))))
+                                     for i in first], dtype=bool)
+                result[misses] = found[inverse]
+            return result
+        cache = {}
+        results = []
+        for ip in ips:
+            if ip not in cache:
+                cache[ip] = self.check(ip)
+            results.append(cache[ip])
+        return results
+
+
+classifier = None
+
+
+def get_classifier():
+    """获取进程内共享的CDN判断器"""
+    global classifier
+    if classifier is None:
+        classifier = CdnClassifier(cdns, ASNS, ASNdata)
+    return classifier
+
+
+def iscdn(ip):
+    return get_classifier().check(ip)
+
+
+def iscdn_many(ips):
+    return get_classifier().check_many(ips)
 
 if __name__ == "__main__":
     print(iscdn('1.1.1.1'))
@@ -19,12 +19,10 @@ class CertSpotter(Query):
         params = {'domain': self.domain,
                   'include_subdomains': 'true',
                   'expand': 'dns_names'}
-        resp = self.get(self.addr, params)
-        if not resp:
-            return
-        subdomains = utils.match_subdomain(self.domain, str(resp.json()))
-        # 合并搜索子域名搜索结果
-        self.subdomains = self.subdomains.union(subdomains)
+        matcher = utils.get_matcher(self.domain)
+        for item in self.get_json_items(self.addr, params):
+            for name in item.get('dns_names') or []:
+                self.subdomains.update(matcher.findall(name))
 
     def run(self):
         """
@@ -17,11 +17,10 @@ class Crtsh(Query):
         self.header = self.get_header()
         self.proxy = self.get_proxy(self.source)
         params = {'q': f'%.{self.domain}', 'output': 'json'}
-        resp = self.get(self.addr, params)
-        if not resp:
-            return
-        subdomains = utils.match_subdomain(self.domain, str(resp.json()))
-        self.subdomains = self.subdomains.union(subdomains)
+        matcher = utils.get_matcher(self.domain)
+        for item in self.get_json_items(self.addr, params):
+            # name_value可能包含多个换行分隔的域名
+            self.subdomains.update(matcher.findall(item.get('name_value') or ''))
 
     def run(self):
         """
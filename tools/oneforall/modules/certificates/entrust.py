@@ -19,11 +19,9 @@ class Entrust(Query):
         params = {'fields': 'subjectDN',
                   'domain': self.domain,
                   'includeExpired': 'true'}
-        resp = self.get(self.addr, params)
-        if not resp:
-            return
-        subdomains = utils.match_subdomain(self.domain, str(resp.json()))
-        self.subdomains = self.subdomains.union(subdomains)
+        matcher = utils.get_matcher(self.domain)
+        for item in self.get_json_items(self.addr, params):
+            self.subdomains.update(matcher.findall(item.get('subjectDN') or ''))
 
     def run(self):
         """
@@ -23,7 +23,7 @@ class Google(Query):
         resp = self.get(self.addr, params)
         if not resp:
             return
-        subdomains = utils.match_subdomain(self.domain, resp.text)
+        subdomains = utils.match_subdomain(self.domain, resp.content)
         # 合并搜索子域名搜索结果
         self.subdomains = self.subdomains.union(subdomains)
 
@@ -46,7 +46,7 @@ class NetCraft(Query):
             resp = self.get(self.addr + last, params)
             if not resp:
                 return
-            subdomains = self.match(self.domain, resp.text)
+            subdomains = self.match(self.domain, resp.content)
             if not subdomains:  # 搜索没有发现子域名则停止搜索
                 break
             # 合并搜索子域名搜索结果
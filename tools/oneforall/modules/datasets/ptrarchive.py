@@ -25,7 +25,7 @@ class PTRArchive(Query):
         if not resp:
             return
         if resp.status_code == 200:
-            subdomains = utils.match_subdomain(self.domain, resp.text)
+            subdomains = utils.match_subdomain(self.domain, resp.content)
             if subdomains:
                 # 合并搜索子域名搜索结果
                 self.subdomains = self.subdomains.union(subdomains)
@@ -19,7 +19,7 @@ class Riddler(Query):
         resp = self.get(self.addr, params)
         if not resp:
             return
-        subdomains = self.match(self.domain, resp.text)
+        subdomains = self.match(self.domain, resp.content)
         # 合并搜索子域名搜索结果
         self.subdomains = self.subdomains.union(subdomains)
 
@@ -30,7 +30,7 @@ class DuckDuckGO(Search):
             resp = self.post(self.addr, data)
             if not resp:
                 return
-            subdomains = self.match(domain, resp.text)
+            subdomains = self.match(domain, resp.content)
             if not subdomains:
                 break
             if not full_search:
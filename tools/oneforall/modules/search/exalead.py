@@ -32,7 +32,7 @@ class Exalead(Search):
             resp = self.get(url=self.addr, params=params)
             if not resp:
                 return
-            subdomains = self.match(domain, resp.text)
+            subdomains = self.match(domain, resp.content)
             if not subdomains:
                 break
             if not full_search:
@@ -25,7 +25,7 @@ class ShodanAPI(Search):
             resp = self.get(self.addr, params)
             if not resp:
                 return
-            subdomains = self.match(self.domain, resp.text)
+            subdomains = self.match(self.domain, resp.content)
             if not subdomains:  # 搜索没有发现子域名则停止搜索
                 break
             if subdomains:
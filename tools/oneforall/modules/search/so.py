@@ -31,7 +31,7 @@ class So(Search):
             resp = self.get(url=self.addr, params=payload)
             if not resp:
                 return
-            subdomains = self.match(domain, resp.text)
+            subdomains = self.match(domain, resp.content)
             if not subdomains:
                 break
             if not full_search:
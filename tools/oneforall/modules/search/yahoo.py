@@ -36,7 +36,7 @@ class Yahoo(Search):
             resp = self.get(self.addr, params)
             if not resp:
                 return
-            subdomains = self.match(domain, resp.text)
+            subdomains = self.match(domain, resp.content)
             if not subdomains:  # 搜索没有发现子域名则停止搜索
                 break
             if not full_search:
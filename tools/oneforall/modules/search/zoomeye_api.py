@@ -48,7 +48,7 @@ class ZoomEyeAPI(Search):
             resp = self.get(self.addr, params)
             if not resp:
                 return
-            subdomains = self.match(self.domain, resp.text)
+            subdomains = self.match(self.domain, resp.content)
             if not subdomains:  # 搜索没有发现子域名则停止搜索
                 break
             self.subdomains = self.subdomains.union(subdomains)
@@ -104,8 +104,8 @@ class OneForAll(object):
             self.dns = Oneforall.enable_dns_resolve
         if self.req is None:
             self.req = Oneforall.enable_http_request
-        old_table = self.domain + '_last_result'
-        new_table = self.domain + '_now_result'
+        db = Database()
+        run_id = db.begin_run(self.domain)
         collect = Collect(self.domain, export=False)
         collect.run()
         if self.brute:
@@ -113,32 +113,20 @@ class OneForAll(object):
             brute = AIOBrute(self.domain, export=False)
             brute.run()
 
-        db = Database()
-        original_table = self.domain + '_original_result'
-        db.copy_table(self.domain, original_table)
-        db.remove_invalid(self.domain)
-        db.deduplicate_subdomain(self.domain)
-
-        old_data = []
-        # 非第一次收集子域的情况时数据库预处理
-        if db.exist_table(new_table):
-            db.drop_table(old_table)  # 如果存在上次收集结果表就先删除
-            db.rename_table(new_table, old_table)  # 新表重命名为旧表
-            old_data = db.get_data(old_table).as_dict()
+        db.remove_invalid(self.domain, run_id)
+        db.deduplicate_subdomain(self.domain, run_id)
+        # 标记新发现子域 与上次完成的扫描比较
+        db.mark_new(self.domain, run_id, db.last_run(self.domain))
 
         # 不解析子域直接导出结果
         if not self.dns:
             # 数据库导出
-            dbexport.export(self.domain, valid=self.valid,
-                            format=self.format, show=self.show)
-            db.drop_table(new_table)
-            db.rename_table(self.domain, new_table)
+            dbexport.export(self.domain, valid=self.valid, format=self.format,
+                            show=self.show, run_id=run_id)
+            db.finish_run(self.domain, run_id)
             db.close()
             return
-        self.data = db.get_data(self.domain).as_dict()
-
-        # 标记新发现子域
-        self.data = utils.mark_subdomain(old_data, self.data)
+        self.data = db.get_data(self.domain, run_id).as_dict()
 
         # 获取事件循环
         loop = asyncio.get_event_loop()
@@ -149,38 +137,34 @@ class OneForAll(object):
         self.data = loop.run_until_complete(task)
 
         # 保存解析结果
-        resolve_table = self.domain + '_resolve_result'
-        db.drop_table(resolve_table)
-        db.create_table(resolve_table)
-        db.save_db(resolve_table, self.data, 'resolve')
+        db.update_resolve(self.data)
 
         # 不请求子域直接导出结果
         if not self.req:
             # 数据库导出
-            dbexport.Warehouse(resolve_table, self.domain)
-            db.drop_table(new_table)
-            db.rename_table(self.domain, new_table)
+            dbexport.Warehouse(self.domain, run_id)
+            db.finish_run(self.domain, run_id)
             db.close()
             return True
 
-        # 请求子域
-        task = request.bulk_request(self.data, self.port)
-        self.data = loop.run_until_complete(task)
-        self.datas.extend(self.data)
+        # 请求子域 请求结果分批写入暂存，全部完成后一次性替换解析结果
+        staging = db.begin_staging(self.domain, run_id)
+
+        def save(results):
+            db.save_db(self.domain, results, 'request', staging)
+
+        task = request.bulk_request(self.data, self.port, save)
+        count = loop.run_until_complete(task)
         # 在关闭事件循环前加入一小段延迟让底层连接得到关闭的缓冲时间
         loop.run_until_complete(asyncio.sleep(0.25))
-        count = utils.count_valid(self.data)
+        db.replace_results(self.domain, run_id, staging)
         logger.log('INFOR', f'经验证{self.domain}有效子域{count}个')
 
-        # 保存请求结果
-        db.clear_table(self.domain)
-        db.save_db(self.domain, self.data, 'request')
-
         # 数据库导出
-        dbexport.export(self.domain, valid=self.valid,
-                        format=self.format, show=self.show)
-        db.drop_table(new_table)
-        db.rename_table(self.domain, new_table)
+        dbexport.export(self.domain, valid=self.valid, format=self.format,
+                        show=self.show, run_id=run_id)
+        self.datas.extend(db.export_data(self.domain, None, run_id).as_dict())
+        db.finish_run(self.domain, run_id)
         db.close()
 
         # 子域接管检查
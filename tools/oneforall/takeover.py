@@ -18,9 +18,9 @@ from tqdm import tqdm
 
 from config import Oneforall
 from web.utils.logs import logger
-from tools.oneforall.common import resolve, utils
+from tools.oneforall.common import dnscache, utils
 from tools.oneforall.common.module import Module
-from tools.oneforall.common.domain import Domain
+from tools.oneforall.common.domain import registered_domain
 
 
 def get_fingerprint():
@@ -31,18 +31,17 @@ def get_fingerprint():
 
 
 def get_cname(subdomain):
-    resolver = resolve.dns_resolver()
-    try:
-        answers = resolver.query(subdomain, 'CNAME')
-    except Exception as e:
-        logger.log('TRACE', e.args)
+    answer = dnscache.query(subdomain, 'CNAME')
+    if isinstance(answer, Exception):
+        logger.log('TRACE', answer.args)
         return None
-    for answer in answers:
-        return answer.to_text()  # 一个子域只有一个CNAME记录
+    # 返回第一跳CNAME记录的目标，与dnspython的to_text格式一致带末尾的点
+    targets = answer.aliases[1:] + [answer.name]
+    return targets[0] + '.'
 
 
 def get_maindomain(subdomain):
-    return Domain(subdomain).registered()
+    return registered_domain(subdomain)
 
 
 class Takeover(Module):
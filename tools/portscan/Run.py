@@ -1,14 +1,19 @@
 import shodan
 import time
+import queue
 import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from config import PortScan
+from sqlalchemy import or_
+
+from config import PortScan, WorkQueue
 from web.models import SrcSubDomain, SrcPorts
 from web import DB
 from web.utils.logs import logger
-from tools.portscan.shodan_scan import scan
-from tools.portscan.socket_scan import socket_main
-from tools.portscan.scan_nmap import Nmap_Portscan
+from web.utils.workqueue import TaskQueue, notify, SUBDOMAIN_CHANNEL, PORT_CHANNEL
+from tools.portscan.shodan_scan import scan, scan_many
+from tools.portscan.socket_scan import socket_main, socket_bulk
+from tools.portscan.scan_nmap import Nmap_Portscan, Nmap_Bulkscan
 
 check = True
 if not PortScan.shodan_api_key:
@@ -26,28 +31,38 @@ else:
         logger.log('ALERT', f'shodan api异常:{e}')
         check = False
 
+if PortScan.cdn_scan:
+    pending = [SrcSubDomain.flag == False, SrcSubDomain.cdn == False]
+else:
+    pending = [SrcSubDomain.flag == False]
+subdomain_queue = TaskQueue(SrcSubDomain, pending, SUBDOMAIN_CHANNEL, WorkQueue.subdomain_lease)
+
 def ReadSubDomain():
-    """读取子域名任务"""
-    if PortScan.cdn_scan:
-        sql_subdomain = SrcSubDomain.query.filter(SrcSubDomain.flag == False, SrcSubDomain.cdn == False).first()
-    else:
-        sql_subdomain = SrcSubDomain.query.filter(SrcSubDomain.flag == False).first()
-    DB.session.commit()
-    return sql_subdomain
+    """批量领取子域名任务，按IP分组，同一IP只扫描一次"""
+    results = subdomain_queue.claim(PortScan.batch_size)
+    groups = {}
+    for result in results:
+        groups.setdefault(result.subdomain_ip, []).append(result.subdomain)
+    return results, groups
 
 def WriteSubDomain(results):
-    """修改子域名任务状态"""
-    sql_subdomain = SrcSubDomain.query.filter(SrcSubDomain.subdomain_ip == results.subdomain_ip).all()
-    DB.session.commit()
-    if sql_subdomain:
-        for tmp in sql_subdomain:
-            tmp.flag = True
-            DB.session.add(tmp)
-        try:
-            DB.session.commit()
-        except Exception as e:
-            DB.session.rollback()
-            logger.log('ALERT', f'更新子域名任务状态SQL错误:{e}')
+    """
+    修改子域名任务状态，批次内子域名及同一IP的其他子域名一条UPDATE全部标记为已扫描
+
+    只释放本进程领取的租约，同一IP上被其他进程领取的子域名保留其租约
+    """
+    subdomains = [result.subdomain for result in results]
+    ips = list({result.subdomain_ip for result in results if result.subdomain_ip})
+    owners = list({result.lease_owner for result in results})
+    try:
+        SrcSubDomain.query.filter(or_(SrcSubDomain.subdomain.in_(subdomains), SrcSubDomain.subdomain_ip.in_(ips)))\
+            .update({'flag': True}, synchronize_session=False)
+        SrcSubDomain.query.filter(SrcSubDomain.lease_owner.in_(owners))\
+            .update({'lease_owner': None, 'lease_time': None}, synchronize_session=False)
+        DB.session.commit()
+    except Exception as e:
+        DB.session.rollback()
+        logger.log('ALERT', f'更新子域名任务状态SQL错误:{e}')
 
 def WritePorts(ip, subdomain, info_dict):
     """端口扫描入库"""
@@ -61,33 +76,129 @@ def WritePorts(ip, subdomain, info_dict):
         except Exception as e:
             DB.session.rollback()
             logger.log('ALERT', f'端口入库SQL错误:{e}')
+        else:
+            notify(PORT_CHANNEL)
 
-def action(ip, subdomain):
+def discover(ip):
+    """shodan -> 异步端口扫描，返回需要nmap识别服务的端口列表"""
     iplist = scan(ip, API)
     if PortScan.async_scan and not iplist:
         iplist1 = socket_main(ip)
         iplist.extend(iplist1)
     if not iplist:
-        return True
+        return None
     if len(iplist) > PortScan.port_num:
-        return True
-    iplist = list(set(iplist))
-    info_dict = Nmap_Portscan(ip, iplist)
-    if info_dict:
-        WritePorts(ip, subdomain, info_dict)
-        return True
+        return None
+    return list(set(iplist))
+
+def action(ip):
+    """单个IP的扫描流程: shodan -> 异步端口扫描 -> nmap服务识别，返回端口服务信息"""
+    iplist = discover(ip)
+    if not iplist:
+        return None
+    return Nmap_Portscan(ip, iplist)
+
+def discover_many(ips):
+    """
+    批量发现开放端口: shodan -> 异步端口扫描，每发现PortScan.discover_chunk个IP产出一次
+
+    :return: 生成器，依次产出IP到待识别端口列表的映射
+    """
+    for i in range(0, len(ips), PortScan.discover_chunk):
+        chunk = ips[i:i + PortScan.discover_chunk]
+        try:
+            # shodan查询受全局限速，先批量读缓存再依次查询未命中的IP
+            targets = scan_many(chunk, API)
+            # shodan无结果的IP在一个事件循环中统一进行异步端口扫描
+            if PortScan.async_scan:
+                missing = [ip for ip in targets if not targets[ip]]
+                for ip, iplist in socket_bulk(missing).items():
+                    targets[ip].extend(iplist)
+        except Exception as e:
+            logger.log('ALERT', f'端口发现{chunk}异常:{e}')
+            continue
+        yield {ip: list(set(iplist)) for ip, iplist in targets.items()
+               if iplist and len(iplist) <= PortScan.port_num}
+
+def bulk_action(pool, groups):
+    """
+    流水线扫描一批IP，当前线程依次发现端口，已发现端口的IP提交到线程池进行nmap识别，
+    识别结果在当前线程入库
+    """
+    ips = [ip for ip in groups if ip]
+    results = queue.Queue()
+
+    def identify(targets):
+        try:
+            for item in Nmap_Bulkscan(targets):
+                results.put(item)
+        except Exception as e:
+            logger.log('ALERT', f'nmap批量识别异常:{e}')
+        finally:
+            results.put(None)  # 这块识别结束
+
+    def write(item):
+        ip, info_dict = item
+        if info_dict and ip in groups:
+            try:
+                WritePorts(ip, groups[ip][0], info_dict)
+            except Exception as e:
+                DB.session.rollback()
+                logger.log('ALERT', f'端口扫描[{ip}]入库异常:{e}')
+
+    pending = 0
+    for targets in discover_many(ips):
+        if targets:
+            pool.submit(identify, targets)
+            pending += 1
+        # 发现下一块之前先写入已完成识别的IP
+        while True:
+            try:
+                item = results.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                pending -= 1
+            else:
+                write(item)
+    while pending:
+        item = results.get()
+        if item is None:
+            pending -= 1
+        else:
+            write(item)
+
+def batch_action(pool, groups):
+    """并发扫描一批IP，先完成的先入库"""
+    if PortScan.nmap_bulk:
+        bulk_action(pool, groups)
+        return
+    ips = [ip for ip in groups if ip]
+    futures = {pool.submit(action, ip): ip for ip in ips}
+    for future in as_completed(futures):
+        ip = futures[future]
+        try:
+            info_dict = future.result()
+        except Exception as e:
+            logger.log('ALERT', f'端口扫描[{ip}]异常:{e}')
+            continue
+        if info_dict:
+            WritePorts(ip, groups[ip][0], info_dict)
 
 def port_main():
     process_name = multiprocessing.current_process().name
     logger.log('INFOR', f'端口服务扫描进程启动:{process_name}')
     if not check:
         return
+    pool = ThreadPoolExecutor(max_workers=PortScan.batch_threads)
     while True:
-        results = ReadSubDomain()
+        results, groups = ReadSubDomain()
         if not results:
-            time.sleep(30)  # 没有任务延迟点时间
+            subdomain_queue.wait()  # 没有任务等待新任务通知
         else:
-            action(results.subdomain_ip, results.subdomain)
+            logger.log('INFOR', f'领取子域名任务{len(results)}个，共{len(groups)}个IP')
+            with subdomain_queue.keepalive(results):
+                batch_action(pool, groups)
             WriteSubDomain(results)
 
 if __name__ == '__main__':
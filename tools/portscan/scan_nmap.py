@@ -1,8 +1,21 @@
+import ipaddress
+import os
+import queue
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
 import nmap
 
 from web.utils.logs import logger
 from config import PortScan
 
+# 进程内所有批量识别共享的nmap进程数上限
+nmap_slots = threading.BoundedSemaphore(PortScan.nmap_processes)
+
 def Nmap_Portscan(ip, port_info_list): # Nmap扫描
     logger.log('INFOR', f'nmap[{ip}]开始扫描')
     try:
@@ -32,5 +45,224 @@ def Nmap_Portscan(ip, port_info_list): # Nmap扫描
         logger.log('INFOR', f'nmap[{ip}]扫描完成')
         return port_dict
 
+def find_nmap():
+    """按配置的搜索路径查找nmap程序"""
+    for path in PortScan.nmap_search_path:
+        nmap_path = shutil.which(path)
+        if nmap_path:
+            return nmap_path
+    return None
+
+def parse_host(host):
+    """解析nmap xml中的一个host节点，返回IP和开放端口服务信息"""
+    address = host.find("address[@addrtype='ipv4']")
+    if address is None:
+        address = host.find("address[@addrtype='ipv6']")
+    if address is None:
+        return None, {}
+    ip = address.get('addr')
+    port_dict = {}
+    for port_info in host.iterfind('ports/port'):
+        if port_info.get('protocol') != 'tcp':
+            continue
+        state = port_info.find('state')
+        if state is None or state.get('state') != 'open':
+            continue
+        port = int(port_info.get('portid'))
+        service = port_info.find('service')
+        if service is None:
+            name = product = version = ''
+        else:
+            name = service.get('name', '')
+            product = service.get('product', '')
+            version = service.get('version', '')
+        port_dict[port] = {'ip': ip, 'port': port, 'name': name, 'product': product, 'version': version}
+        logger.log('INFOR', f'nmap扫描:{ip}:{port} {name} {product} {version}')
+    return ip, port_dict
+
+def split_targets(targets):
+    """
+    按地址族拆分扫描目标，nmap扫描IPv6目标需要-6参数，不能与IPv4目标放在同一个进程
+
+    :return: (是否IPv6, 规范化IP到原IP的映射)列表
+    """
+    families = {False: {}, True: {}}
+    for ip in targets:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            logger.log('ALERT', f'nmap批量扫描跳过无效IP:{ip}')
+            continue
+        families[address.version == 6][address.compressed] = ip
+    return [(ipv6, ips) for ipv6, ips in families.items() if ips]
+
+def nmap_scan(nmap_path, ips, ports, ipv6=False):
+    """
+    一个nmap进程扫描一组IP，边扫描边解析xml输出，每完成一个IP就返回该IP的结果
+
+    :param str nmap_path: nmap程序路径
+    :param list ips: IP列表
+    :param list ports: 扫描的端口
+    :param bool ipv6: 是否IPv6目标
+    :return: 生成器，依次产出(ip, 端口服务信息)
+    """
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as file:
+        file.write('\n'.join(ips))
+    cmd = [nmap_path, '-iL', file.name, '-p', ','.join(map(str, ports)),
+           '-Pn', '-T4', '-sV', '--version-intensity=3', '-oX', '-']
+    if ipv6:
+        cmd.append('-6')
+    # 错误输出写入临时文件，避免管道写满阻塞nmap
+    stderr = tempfile.TemporaryFile()
+    proc = None
+    timer = None
+    killed = False
+    acquired = False
+    timeout = threading.Event()
+
+    def expire():
+        timeout.set()
+        proc.kill()
+
+    try:
+        nmap_slots.acquire()
+        acquired = True
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr)
+        # 整个nmap进程的运行时间上限，超时结束进程，避免卡住任务租约
+        timer = threading.Timer(PortScan.nmap_timeout, expire)
+        timer.daemon = True
+        timer.start()
+        for event, elem in ElementTree.iterparse(proc.stdout, events=('end',)):
+            if elem.tag != 'host':
+                continue
+            ip, port_dict = parse_host(elem)
+            elem.clear()  # 已解析的host节点及时释放
+            if ip:
+                yield ip, port_dict
+    except ElementTree.ParseError as e:
+        if not timeout.is_set():
+            logger.log('ERROR', f'nmap批量扫描结果解析异常:{e}')
+    except GeneratorExit:  # 调用方提前停止时结束nmap进程
+        killed = True
+        proc.kill()
+        raise
+    finally:
+        returncode = None
+        if timer is not None:
+            timer.cancel()
+        if proc is not None:
+            proc.stdout.close()
+            returncode = proc.wait()
+        if acquired:
+            nmap_slots.release()
+        os.remove(file.name)
+        stderr.seek(0)
+        message = stderr.read().decode('utf-8', errors='replace').strip()
+        stderr.close()
+        if timeout.is_set() and not killed:
+            logger.log('ERROR', f'nmap批量扫描超过{PortScan.nmap_timeout}秒被终止，共{len(ips)}个IP')
+        elif returncode and not killed:
+            logger.log('ERROR', f'nmap批量扫描异常退出，返回码{returncode}:{message}')
+        elif message:
+            logger.log('ALERT', f'nmap批量扫描错误输出:{message}')
+
+def group_targets(requested):
+    """
+    按待识别端口集合把IP分组，每组一个nmap进程扫描这组端口的并集
+
+    端口集合相同的IP直接合并；端口集合相近的组在并集不超过PortScan.nmap_group_ports个端口，
+    且组内每个IP自己的端口占并集的比例不低于PortScan.nmap_group_overlap时合并，
+    避免每个IP单独一个nmap进程，同时限制对IP未请求端口的探测
+
+    :param dict requested: IP到待识别端口集合的映射
+    :return: (端口列表, IP列表)列表
+    """
+    exact = {}
+    for ip, ports in requested.items():
+        exact.setdefault(frozenset(ports), []).append(ip)
+    groups = []  # [端口并集, 组内最小端口数, IP列表]
+    for ports, ips in sorted(exact.items(), key=lambda item: len(item[0]), reverse=True):
+        for group in groups:
+            union = group[0] | ports
+            smallest = min(group[1], len(ports))
+            if len(union) <= PortScan.nmap_group_ports and \
+                    smallest >= len(union) * PortScan.nmap_group_overlap:
+                group[0] = union
+                group[1] = smallest
+                group[2].extend(ips)
+                break
+        else:
+            groups.append([ports, len(ports), list(ips)])
+    return [(sorted(ports), ips) for ports, _, ips in groups]
+
+def Nmap_Bulkscan(targets):
+    """
+    批量扫描多个IP，边扫描边解析xml输出，每完成一个IP就返回该IP的结果
+
+    nmap的-p参数对所有目标生效，这里按端口集合把IP分组，每组一个nmap进程，
+    解析结果时只保留该IP自己待识别的端口；IPv4和IPv6目标分开扫描，
+    最多同时运行PortScan.nmap_processes个nmap进程
+
+    :param dict targets: IP到待识别端口列表的映射
+    :return: 生成器，依次产出(ip, 端口服务信息)
+    """
+    if not targets:
+        return
+    nmap_path = find_nmap()
+    if not nmap_path:
+        logger.log('ERROR', f'nmap程序未找到:{PortScan.nmap_search_path}')
+        return
+    jobs = []
+    requested = {}
+    for ipv6, ips in split_targets(targets):
+        family = {address: {int(port) for port in targets[ip]} for address, ip in ips.items()}
+        requested.update(family)
+        for ports, addresses in group_targets(family):
+            jobs.append((ipv6, ips, ports, addresses))
+    if not jobs:
+        return
+    logger.log('INFOR', f'nmap批量扫描开始，共{len(requested)}个IP，分为{len(jobs)}组')
+    results = queue.Queue()
+    stop = threading.Event()
+
+    def worker(ipv6, ips, ports, addresses):
+        try:
+            if stop.is_set():
+                return
+            for address, port_dict in nmap_scan(nmap_path, addresses, ports, ipv6):
+                address = ipaddress.ip_address(address).compressed
+                ip = ips.get(address)
+                if ip is None:
+                    continue
+                # 只保留该IP待识别的端口，同组其他IP的端口不计入该IP
+                port_dict = {port: info for port, info in port_dict.items() if port in requested[address]}
+                for info in port_dict.values():
+                    info['ip'] = ip
+                results.put((ip, port_dict))
+                if stop.is_set():  # 调用方已停止，结束这组nmap进程
+                    break
+        except Exception as e:
+            logger.log('ERROR', f'nmap批量扫描异常:{e}')
+        finally:
+            results.put(None)  # 这组扫描结束
+
+    count = 0
+    pending = len(jobs)
+    pool = ThreadPoolExecutor(max_workers=min(PortScan.nmap_processes, pending))
+    try:
+        for job in jobs:
+            pool.submit(worker, *job)
+        while pending:
+            item = results.get()
+            if item is None:
+                pending -= 1
+                continue
+            count += 1
+            yield item
+    finally:
+        stop.set()
+        pool.shutdown(wait=False)
+    logger.log('INFOR', f'nmap批量扫描完成，共{count}个IP')
+
 if __name__ == '__main__':
-    pass
\ No newline at end of file
+    pass
@@ -1,20 +1,179 @@
+import datetime
+import json
+import threading
+import time
+
+import shodan
+
+from config import PortScan
+from web import DB
+from web.models import ShodanCache
 from web.utils.logs import logger
+from web.utils.workqueue import get_redis
 
-def scan(ip, API):
-    logger.log('INFOR', f'开始Shodan端口扫描[{ip}]')
+# redis令牌桶脚本，返回还需等待的秒数，为0表示已取得令牌
+TOKEN_BUCKET_SCRIPT = '''
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(redis.call('hget', KEYS[1], 'tokens'))
+local ts = tonumber(redis.call('hget', KEYS[1], 'ts'))
+if tokens == nil or ts == nil then
+    tokens = burst
+    ts = now
+end
+tokens = math.min(burst, tokens + math.max(now - ts, 0) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('hmset', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('expire', KEYS[1], 60)
+return tostring(wait)
+'''
+
+# shodan没有该IP数据时返回404，shodan库抛出的APIError不带状态码，只能按错误信息判断
+NOT_FOUND = 'No information available'
+
+
+class TokenBucket(object):
+    """
+    令牌桶限速器，redis可用时所有进程共享一个令牌桶，否则在进程内限速
+
+    :param str key: 令牌桶名称
+    :param float rate: 每秒产生令牌数
+    :param int burst: 令牌桶容量
+    """
+
+    def __init__(self, key, rate, burst=1):
+        self.key = key
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.tokens = burst
+        self.last = time.time()
+        self.script = None
+
+    def acquire_local(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire_shared(self, client):
+        if self.script is None:
+            self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+        return float(self.script(keys=[self.key], args=[self.rate, self.burst, time.time()]))
+
+    def acquire(self):
+        """阻塞直到取得一个令牌"""
+        while True:
+            client = get_redis()
+            try:
+                wait = self.acquire_shared(client) if client else self.acquire_local()
+            except Exception as e:
+                logger.log('DEBUG', f'共享限速器异常，使用进程内限速:{e}')
+                wait = self.acquire_local()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+
+bucket = TokenBucket('bayonet:shodan', PortScan.shodan_rate)
+
+
+def read_cache(ips):
+    """批量读取未过期的缓存，返回IP到端口列表的映射"""
+    now = datetime.datetime.now()
+    positive = now - datetime.timedelta(seconds=PortScan.shodan_cache_ttl)
+    negative = now - datetime.timedelta(seconds=PortScan.shodan_negative_ttl)
+    cache = {}
+    try:
+        rows = ShodanCache.query.filter(ShodanCache.ip.in_(list(ips))).all()
+        DB.session.commit()
+    except Exception as e:
+        DB.session.rollback()
+        logger.log('ALERT', f'读取Shodan缓存SQL错误:{e}')
+        return cache
+    for row in rows:
+        if row.found and row.query_time > positive:
+            cache[row.ip] = json.loads(row.ports)
+        elif not row.found and row.query_time > negative:
+            cache[row.ip] = []
+    return cache
+
+
+def write_cache(ip, ports, found):
+    """写入缓存，已存在则覆盖"""
+    try:
+        DB.session.merge(ShodanCache(ip=ip, ports=json.dumps(ports), found=found))
+        DB.session.commit()
+    except Exception as e:
+        DB.session.rollback()
+        logger.log('ALERT', f'写入Shodan缓存SQL错误:{e}')
+
+
+def query(ip, API):
+    """限速查询shodan，查询失败返回None"""
+    bucket.acquire()
     try:
         ipinfo = API.host(ip)
+    except shodan.APIError as e:
+        # 没有该IP数据属于确定结果可以缓存
+        if str(e).startswith(NOT_FOUND):
+            logger.log('INFOR', f'Shodan无[{ip}]数据')
+            write_cache(ip, [], False)
+            return []
+        logger.log('ALERT', f'Shodan查询[{ip}]失败，原因:{e}')
+        return None
     except Exception as e:
         logger.log('ALERT', f'Shodan查询[{ip}]失败，原因:{e}')
-        return []
+        return None
     port_list = ipinfo['data']
     result_list = []
     for tmp in port_list:
         port = tmp.get('port', '0')
         if port:
             result_list.append(port)
+    write_cache(ip, result_list, True)
+    return result_list
+
+
+def scan(ip, API):
+    logger.log('INFOR', f'开始Shodan端口扫描[{ip}]')
+    cache = read_cache([ip])
+    if ip in cache:
+        logger.log('INFOR', f'Shodan端口扫描命中缓存;[{ip}] {cache[ip]}')
+        return cache[ip]
+    result_list = query(ip, API)
+    if result_list is None:
+        return []
     logger.log('INFOR', f'Shodan端口扫描完成;[{ip}] {result_list}')
     return result_list
 
+
+def scan_many(ips, API):
+    """
+    批量Shodan端口扫描，一次查询缓存，只对未命中的IP限速请求shodan
+
+    :param list ips: IP列表
+    :return: IP到端口列表的映射
+    """
+    results = read_cache(ips)
+    logger.log('INFOR', f'Shodan批量扫描{len(ips)}个IP，命中缓存{len(results)}个')
+    for ip in ips:
+        if ip in results:
+            continue
+        result_list = query(ip, API)
+        results[ip] = result_list or []
+        logger.log('INFOR', f'Shodan端口扫描完成;[{ip}] {results[ip]}')
+    return results
+
 if __name__ == '__main__':
     pass
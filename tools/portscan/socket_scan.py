@@ -124,38 +124,122 @@ PORTS = [21, 22, 23, 80, 81, 280, 300, 443, 591, 593, 832, 888, 901, 981, 1010,
                    9294, 9295, 9443, 9444, 9800, 9981, 9988, 9990, 9999, 10000,
                    10880]
 
-result_port = []
-
-async def Scan(ip, port):
+def raise_nofile_limit(need):
+    """提高进程可打开文件数上限，保证并发连接数不受默认1024限制"""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= need:
+        return
+    if hard != resource.RLIM_INFINITY:
+        need = min(need, hard)
     try:
-        reader, writer = await asyncio.open_connection(host=ip, port=port)
-        writer.close()
-        await writer.wait_closed()
-    except Exception as e:
-        pass
-    else:
-        result_port.append(port)
-
-async def action(ip, threads, timeout):
-    ports = [Scan(ip, port) for port in PORTS]
-    n = int(threads)
-    if n > len(ports):
-        n = len(ports)-1
-    tasks = [ports[i:i + n] for i in range(0, len(ports), n)]
-    for task in tasks:
-        await asyncio.wait(task, timeout=timeout)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (need, hard))
+    except (ValueError, OSError) as e:
+        logger.log('DEBUG', f'提高文件描述符上限失败:{e}')
+
+
+class SocketScanner(object):
+    """
+    异步TCP connect端口扫描引擎
+
+    同一个事件循环中的所有扫描共享一个并发预算，可一次扫描多个IP的任意端口
+
+    :param int concurrency: 同时进行的连接数
+    :param float timeout: 单个连接超时时间(秒)
+    """
+
+    def __init__(self, concurrency=None, timeout=None):
+        self.concurrency = concurrency or PortScan.async_scan_threads
+        self.timeout = timeout or PortScan.async_connect_timeout
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        raise_nofile_limit(self.concurrency + 256)
+
+    async def connect(self, ip, port):
+        """探测单个端口，返回端口是否开放"""
+        async with self.semaphore:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host=ip, port=port),
+                                                        timeout=self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                return False
+            writer.close()
+            try:
+                await asyncio.wait_for(writer.wait_closed(), timeout=self.timeout)
+            except (OSError, asyncio.TimeoutError):
+                pass
+            return True
+
+    async def scan(self, targets):
+        """
+        扫描(ip, port)序列，以异步生成器逐个返回开放的端口
+
+        任务按并发数分批创建，不会一次生成全部任务；生成器提前关闭时取消剩余任务
+
+        :param targets: (ip, port)可迭代对象
+        """
+        pending = {}
+        targets = iter(targets)
+        try:
+            while True:
+                for ip, port in targets:
+                    task = asyncio.ensure_future(self.connect(ip, port))
+                    pending[task] = (ip, port)
+                    if len(pending) >= self.concurrency:
+                        break
+                if not pending:
+                    break
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    target = pending.pop(task)
+                    if task.result():
+                        yield target
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+
+def gen_targets(ips, ports=None):
+    """生成多个IP的(ip, port)扫描目标，按端口交错排列以分散单个IP的压力"""
+    ports = sorted(set(ports or PORTS))
+    for port in ports:
+        for ip in ips:
+            yield ip, port
+
+
+async def sweep(ips, ports=None):
+    """批量扫描多个IP，返回IP到开放端口列表的映射"""
+    scanner = SocketScanner()
+    result = {ip: [] for ip in ips}
+    async for ip, port in scanner.scan(gen_targets(ips, ports)):
+        result[ip].append(port)
+    return result
+
+
+def socket_bulk(ips, ports=None):
+    """在一个事件循环中扫描多个IP的开放端口"""
+    ips = list(ips)
+    if not ips:
+        return {}
+    start = time.time()
+    logger.log('INFOR', f'开始异步扫描{len(ips)}个IP开放端口')
+    result = asyncio.run(sweep(ips, ports))
+    stop = round(time.time() - start, 1)
+    logger.log('INFOR', f'异步扫描{len(ips)}个IP开放端口完成，计时:{stop}')
+    return result
+
 
 def socket_main(ip):
-    global result_port
-    result_port = []
     start = time.time()
     logger.log('INFOR', f'开始异步扫描[{ip}]开放端口')
-    threads = PortScan.async_scan_threads
-    asyncio.run(action(ip, threads, PortScan.async_scan_timeout))
+    result_port = asyncio.run(sweep([ip]))[ip]
     stop = time.time()-start
     logger.log('INFOR', f'异步扫描[{ip}]开放端口完成，计时:{stop},结果:{result_port}')
     return result_port
 
 if __name__ == '__main__':
-    socket_main('210.47.0.4')
-    print(result_port)
\ No newline at end of file
+    print(socket_main('210.47.0.4'))
@@ -1,39 +1,37 @@
 import subprocess
 import json
-import tldextract
-import socket
 import pathlib
 import uuid
 from concurrent.futures import ThreadPoolExecutor
-import time
 import multiprocessing
 
 from web.models import SrcUrls
-from web import DB
 from web.utils.logs import logger
-from config import crawlergo
+from web.utils.workqueue import TaskQueue, notify, URL_CHANNEL, SUBDOMAIN_CHANNEL
+from config import crawlergo, WorkQueue
 from tools.oneforall.iscdn import iscdn
-from tools.oneforall.dbexport import SelectIP, WriteDb
+from tools.oneforall.dbexport import WriteDb
+from tools.oneforall.iplocate import locate
+from tools.oneforall.common import dnscache
+from tools.oneforall.common.domain import registered_many
 
 crawlergo_path = str(pathlib.Path(__file__).parent.joinpath('crawlergo').resolve())
 
 
+url_queue = TaskQueue(SrcUrls, [SrcUrls.flag == True], URL_CHANNEL, WorkQueue.url_lease)
+
+
 def ReadUrl():
-    """读取url任务, 一次读取一条记录"""
-    sql_url = SrcUrls.query.filter(SrcUrls.flag == True).first()
-    DB.session.commit()
-    return sql_url
+    """领取url任务, 一次领取一条记录"""
+    results = url_queue.claim()
+    if results:
+        return results[0]
+    return None
 
 
 def WriteUrl(sql_url):
     """修改爬虫任务状态"""
-    sql_url.flag = False
-    sql_url.reptile = True
-    try:
-        DB.session.commit()
-    except Exception as e:
-        DB.session.rollback()
-        logger.log('ALERT', '修改URL任务状态SQL错误:%s' % e)
+    url_queue.done([sql_url], flag=False, reptile=True)
 
 
 def action(target):
@@ -56,34 +54,24 @@ def action(target):
 
 def WriteSubdomain(req_subdomain):
     """子域名入库"""
+    domains = registered_many(req_subdomain)
     for subdomain in req_subdomain:
         ip = domain_ip(subdomain)
         if not ip:
             continue
         cdn = iscdn(ip)
-        city = SelectIP(ip)
-        domain = FindDomain(subdomain)
+        city = locate(ip)
+        domain = domains[subdomain]
         WriteDb(subdomain, domain, ip, city, cdn)
-
-
-def FindDomain(subdomain):
-    """提取主域名"""
-    try:
-        result = tldextract.extract(subdomain)
-    except:
-        return None
-    else:
-        return result.domain + '.' + result.suffix
+    notify(SUBDOMAIN_CHANNEL)
 
 
 def domain_ip(subdomain):
     """域名转IP"""
-    try:
-        ip = socket.gethostbyname(subdomain)
-    except:
+    answer = dnscache.query(subdomain)
+    if isinstance(answer, Exception):
         return None
-    else:
-        return ip
+    return answer.ips[0]
 
 
 def write_request(dict1):
@@ -110,13 +98,14 @@ def main():
     while True:
         sql_url = ReadUrl()
         if not sql_url:
-            time.sleep(30)
+            url_queue.wait()
         else:
             req_dict = {}
             url = sql_url.url
             logger.log('INFOR', f'[{url}]开始爬虫')
             futurel = pool.submit(action, url)
-            req_result = futurel.result()
+            with url_queue.keepalive([sql_url]):
+                req_result = futurel.result()
             if req_result:
                 if req_result[1]:
                     WriteSubdomain(req_result[1])
@@ -1,17 +1,24 @@
+import asyncio
+import collections
+import hashlib
+import datetime
 import ipaddress
+import multiprocessing
 import random
+import re
+import secrets
+from concurrent.futures import ThreadPoolExecutor
 
-import chardet
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
 
-from config import UrlScan
-from web import DB, celery
+from config import UrlScan, WorkQueue
 from tools.urlscan.wafw00f.main import main
 from web.models import SrcPorts, SrcUrls
+from web.utils.auxiliary import bulk_insert_ignore
 from web.utils.logs import logger
+from web.utils.webpage import get_title, get_encoding, read_body
+from web.utils.workqueue import TaskQueue, PORT_CHANNEL
 
-requests.packages.urllib3.disable_warnings()
 user_agents = [
     'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
     '(KHTML, like Gecko) Chrome/76.0.3809.100 Safari/537.36',
@@ -24,132 +31,172 @@ user_agents = [
     'Gecko/20100101 Firefox/68.0',
     'Mozilla/5.0 (X11; Linux i586; rv:31.0) Gecko/20100101 Firefox/68.0']
 
+port_queue = TaskQueue(SrcPorts, [SrcPorts.flag == False], PORT_CHANNEL, WorkQueue.port_lease)
+
+# 探测到的网页，text为按识别出的编码解码后的响应文本
+Page = collections.namedtuple('Page', ['url', 'status', 'headers', 'text'])
+# 响应指纹，digest为响应体开头部分的摘要
+Fingerprint = collections.namedtuple('Fingerprint', ['status', 'digest'])
+
+FINGERPRINT_SIZE = 4 * 1024  # 计算响应指纹读取的字节数
+DIGEST_SIZE = 2 * 1024  # 去掉易变内容后参与摘要的字节数，两次响应去掉的内容长度不同时仍取到相同范围
+# 响应中每次请求都会变化的内容，如时间戳、CSRF令牌和请求ID
+VOLATILE = re.compile(rb'\d+|[\w+/=-]{16,}')
+# 只限制建立连接和每次读取的时间，等待连接池空闲连接的时间不计入超时
+TIMEOUT = aiohttp.ClientTimeout(total=None, sock_connect=UrlScan.timeout, sock_read=UrlScan.timeout)
+
 
 def ReadPort():
-    """读取ports表任务"""
-    sql_ports_list = SrcPorts.query.filter(SrcPorts.flag == False).limit(UrlScan.threads).all()
-    return sql_ports_list
+    """批量领取ports表任务"""
+    return port_queue.claim(UrlScan.batch_size)
+
+
+def WritePort(results):
+    """修改ports表任务状态"""
+    port_queue.done(results, flag=True)
 
 
-def WritePort(sql_ports):
-    """修改ports表任务"""
+def WriteUrls(rows):
+    """批量入库url，已存在的url忽略"""
+    if not rows:
+        return 0
+    count = bulk_insert_ignore(SrcUrls, rows)
+    logger.log('INFOR', f'url探测:新入库url{count}个')
+    return count
+
+
+async def fetch(session, url):
+    """
+    请求url，响应体最多读取UrlScan.read_size字节
+
+    :return: 网页，请求失败返回None
+    """
     try:
-        SrcPorts.query.filter(SrcPorts.id == sql_ports.id).update(dict(flag=True))
-        DB.session.commit()
+        async with session.get(url, headers=gen_fake_header(), ssl=False,
+                               timeout=TIMEOUT) as resp:
+            return await read_page(resp)
     except Exception as e:
-        DB.session.rollback()
-        logger.log('ALERT', f'更新端口ports任务状态SQL错误:{e}')
+        logger.log('DEBUG', f'url探测:请求{url}出错{e!r}')
+        return None
+
+
+async def read_page(resp, head=b''):
+    """
+    读取响应生成网页
+
+    :param resp: aiohttp响应对象
+    :param bytes head: 已经读取的响应体开头部分
+    :return: 网页
+    """
+    body = head + await read_body(resp.content, UrlScan.read_size - len(head))
+    encoding = get_encoding(body, resp.headers.get('Content-Type'))
+    return Page(str(resp.url), resp.status, resp.headers,
+                body.decode(encoding, errors='replace'))
+
+
+async def check_http(session, sql_ports):
+    """
+    HTTP服务探测，http和https同时请求
+
+    按成功状态码、需要二级目录查找的状态码、其他状态码的顺序选用响应，同一顺序下优先http
 
+    :return: 网页，非HTTP服务返回None
+    """
+    urls = [f'{scheme}://{sql_ports.subdomain}:{sql_ports.port}' for scheme in ('http', 'https')]
+    pages = [page for page in await asyncio.gather(*[fetch(session, url) for url in urls]) if page]
+    for status_code in (UrlScan.success_status_code, UrlScan.failure_status_code):
+        for page in pages:
+            if page.status in status_code:
+                return page
+    return pages[0] if pages else None
 
-def WirteUrl(url, subdomain, title, fingerprint, waf):
-    if len(url) > 300:
+
+async def gen_url(page, sql_ports):
+    """识别标题、指纹和waf，生成url入库数据"""
+    if len(page.url) > 300:
         return None
-    try:
-        sql_urls = SrcUrls(url=url, subdomain=subdomain, title=title, fingerprint=fingerprint, waf=waf)
-        DB.session.add(sql_urls)
-        DB.session.commit()
-    except Exception as e:
-        DB.session.rollback()
-        logger.log('ALERT', f'入库urls任务SQL错误:{e}')
+    title = get_title(markup=page.text)
+    banner = get_banner(page.headers)
+    # waf检测使用同步请求，放到线程池中执行
+    falg, waf = await asyncio.get_event_loop().run_in_executor(None, main, page.url)
+    if not falg:
+        waf = ''
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return {'url': page.url, 'subdomain': sql_ports.subdomain, 'title': title,
+            'fingerprint': banner, 'waf': waf, 'reptile': False, 'flag': False,
+            'w13scan': False, 'xray': False, 'url_time': now}
+
 
+async def action(session, sql_ports):
+    """
+    探测一个端口
 
-def action(sql_ports):
+    :return: url入库数据，没有发现url返回None
+    """
     logger.log('INFOR', f'url开始探测:{sql_ports.subdomain}:{sql_ports.port}')
-    response = check_http(sql_ports)
-    if response == None:  # 非HTTP服务
+    page = await check_http(session, sql_ports)
+    if page is None:  # 非HTTP服务
         logger.log('INFOR', f'url探测:{sql_ports.subdomain}:{sql_ports.port}非HTTP服务')
-        WritePort(sql_ports)
         return None
-    if response.status_code in UrlScan.success_status_code:
-        mychar = chardet.detect(response.content)
-        bianma = mychar['encoding']  # 自动识别编码
-        response.encoding = bianma
-        title = get_title(markup=response.text)
-        banner = get_banner(response.headers)
-        falg, waf = main(response.url)
-        if not falg:
-            waf = ''
-        WritePort(sql_ports)
-        WirteUrl(response.url, sql_ports.subdomain, title, banner, waf)
-        logger.log('INFOR', f'url探测:{response.url}查找完毕')
-        return True
-    elif response.status_code in UrlScan.failure_status_code:
-        WritePort(sql_ports)
+    if page.status in UrlScan.success_status_code:
+        row = await gen_url(page, sql_ports)
+        logger.log('INFOR', f'url探测:{page.url}查找完毕')
+        return row
+    elif page.status in UrlScan.failure_status_code:
         if not UrlScan.subdirectory:
             return None
-        logger.log('INFOR', f'url探测:{response.url}开始二级目录查找')
-        sucess = sub_path_main(response.url)
+        logger.log('INFOR', f'url探测:{page.url}开始二级目录查找')
+        sucess = await sub_path_main(session, page.url)
         if not sucess:
-            logger.log('INFOR', f'url探测:{response.url}二级目录未查找到')
-        else:
-            logger.log('INFOR', f'url探测:{response.url}二级目录已查找到[{len(sucess)}]个')
-            response = sucess[0]
-            mychar = chardet.detect(response.content)
-            bianma = mychar['encoding']  # 自动识别编码
-            response.encoding = bianma
-            title = get_title(markup=response.text)
-            banner = get_banner(response.headers)
-            falg, waf = main(response.url)
-            if not falg:
-                waf = ''
-            WirteUrl(response.url, sql_ports.subdomain, title, banner, waf)
-            logger.log('INFOR', f'url探测:二级目录 {response.url}查找完毕')
-            return True
+            logger.log('INFOR', f'url探测:{page.url}二级目录未查找到')
+            return None
+        logger.log('INFOR', f'url探测:{page.url}二级目录已查找到[{len(sucess)}]个')
+        page = sucess[0]
+        row = await gen_url(page, sql_ports)
+        logger.log('INFOR', f'url探测:二级目录 {page.url}查找完毕')
+        return row
     else:
-        logger.log('DEBUG', f'url探测:{response.url}为其他状态码[{response.status_code}]')
-        WritePort(sql_ports)
+        logger.log('DEBUG', f'url探测:{page.url}为其他状态码[{page.status}]')
+        return None
 
 
-def check_http(sql_ports):
-    """HTTP服务探测"""
-    url = f'http://{sql_ports.subdomain}:{sql_ports.port}'
-    headers = gen_fake_header()
-    try:
-        response = requests.get(url, timeout=UrlScan.timeout, headers=headers)
-    except requests.exceptions.SSLError:
-        url = f'https://{sql_ports.subdomain}:{sql_ports.port}'
-        try:
-            response = requests.get(url, timeout=UrlScan.timeout, verify=False, headers=headers)
-        except Exception as e:
-            return None
-        else:
-            return response
-    except Exception as e:
-        return None
-    else:
-        return response
+async def scan_batch(results):
+    """
+    并发探测一批端口，同时探测的端口数不超过UrlScan.threads，所有请求共用一个连接池
 
+    连接池的limit_per_host按主机、端口和协议计数，同一主机的多个端口仍会同时打开大量连接，
+    因此按主机限制同时探测的端口数，使同一主机的连接数不超过UrlScan.limit_per_host
 
-def get_title(markup):
-    """获取网页标题"""
-    try:
-        soup = BeautifulSoup(markup, 'lxml')
-    except:
-        return None
-    title = soup.title
-    if title:
-        return title.text.strip()
-    h1 = soup.h1
-    if h1:
-        return h1.text.strip()
-    h2 = soup.h2
-    if h2:
-        return h2.text.strip()
-    h3 = soup.h3
-    if h2:
-        return h3.text.strip()
-    desc = soup.find('meta', attrs={'name': 'description'})
-    if desc:
-        return desc['content'].strip()
-    word = soup.find('meta', attrs={'name': 'keywords'})
-    if word:
-        return word['content'].strip()
-    if len(markup) <= 200:
-        return markup.strip()
-    text = soup.text
-    if len(text) <= 200:
-        return text.strip()
-    return None
+    :param list results: 端口任务列表
+    :return: url入库数据列表
+    """
+    # 每个端口根目录探测同时请求http和https，二级目录查找同时请求subdirectory_threads个路径
+    per_port = max(2, UrlScan.subdirectory_threads) if UrlScan.subdirectory else 2
+    per_port = min(per_port, UrlScan.limit_per_host)
+    connector = aiohttp.TCPConnector(limit=UrlScan.threads * per_port,
+                                     limit_per_host=per_port,
+                                     ssl=False)
+    semaphore = asyncio.Semaphore(UrlScan.threads)
+    # 每个主机同时探测的端口数
+    hosts = collections.defaultdict(lambda: asyncio.Semaphore(max(1, UrlScan.limit_per_host // per_port)))
+
+    async def probe(sql_ports):
+        # 先占用主机名额再占用全局名额，等待同一主机其他端口时不占用全局名额
+        async with hosts[sql_ports.subdomain], semaphore:
+            try:
+                return await asyncio.wait_for(action(session, sql_ports), UrlScan.port_timeout)
+            except asyncio.TimeoutError:
+                logger.log('ALERT', f'url探测:{sql_ports.subdomain}:{sql_ports.port}'
+                                    f'超过{UrlScan.port_timeout}秒未完成，放弃探测')
+                return None
+            except Exception as e:
+                logger.log('ALERT', f'url探测:{sql_ports.subdomain}:{sql_ports.port}异常{e!r}')
+                return None
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+        rows = await asyncio.gather(*[probe(sql_ports) for sql_ports in results])
+    # 同一批次中不同端口可能跳转到同一url
+    return list({row['url']: row for row in rows if row}.values())
 
 
 def get_banner(headers):
@@ -178,7 +225,7 @@ def gen_fake_header():
     headers = {
         'Accept': 'text/html,application/xhtml+xml,'
                   'application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Encoding': 'gzip, deflate, br',
+        'Accept-Encoding': 'gzip, deflate',
         'Accept-Language': 'en-US,en;q=0.9,zh-CN;q=0.8,zh;q=0.7',
         'Cache-Control': 'max-age=0',
         'Connection': 'keep-alive',
@@ -192,35 +239,124 @@ def gen_fake_header():
     return headers
 
 
-@celery.task
 def urlscan_main():
-    logger.log('INFOR', f'可用URL探测进程启动:')
-    sql_ports_list = ReadPort()
-    if not sql_ports_list:
-        logger.log('INFOR', f'无可用端口')
-    else:
-        for sql_port in sql_ports_list:
-            action(sql_port)
+    process_name = multiprocessing.current_process().name
+    logger.log('INFOR', f'可用URL探测进程启动:{process_name}')
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=UrlScan.threads))
+    while True:
+        results = ReadPort()
+        if not results:
+            port_queue.wait()  # 没有任务等待新任务通知
+            continue
+        logger.log('INFOR', f'领取端口任务{len(results)}个')
+        with port_queue.keepalive(results):
+            rows = loop.run_until_complete(scan_batch(results))
+        WriteUrls(rows)
+        WritePort(results)
 
 
-def sub_path_main(url):
-    sucess = []
-    for path in UrlScan.subdirectory_path:
-        response = sub_chek(url + '/' + path)
-        if response:
-            if response.status_code in UrlScan.success_status_code:
-                sucess.append(response)
-    return sucess
+async def get_fingerprint(session, url):
+    """
+    请求一个随机不存在的路径，得到主机对不存在路径的响应指纹
+
+    :return: 响应指纹，请求失败返回None
+    """
+    path = secrets.token_hex(6)
+    try:
+        async with session.get(f'{url}/{path}', headers=gen_fake_header(),
+                               ssl=False, timeout=TIMEOUT) as resp:
+            head = await read_body(resp.content, FINGERPRINT_SIZE)
+            return Fingerprint(resp.status, get_digest(head, path))
+    except Exception as e:
+        logger.log('DEBUG', f'url探测:{url}获取不存在路径的响应出错{e!r}')
+        return None
+
+
+def get_digest(head, path):
+    """
+    计算响应体开头部分的摘要
+
+    不存在路径的响应常会回显请求路径，或带有时间戳、CSRF令牌等每次都不同的内容，
+    先去掉这些内容再计算摘要
+
+    :param bytes head: 响应体开头部分
+    :param str path: 请求的路径
+    :return: 摘要
+    """
+    head = head.replace(f'/{path}'.encode(), b'')
+    head = VOLATILE.sub(b'', head)[:DIGEST_SIZE]
+    return hashlib.md5(head).hexdigest()
+
 
+async def sub_chek(session, url, baseline):
+    """
+    探测二级目录
 
-def sub_chek(url):
-    headers = gen_fake_header()
+    状态码不是成功状态码的直接返回，状态码和响应体开头部分都与不存在路径的响应指纹相同的在读取完整响应体前丢弃
+
+    :param str url: 二级目录url
+    :param baseline: 不存在路径的响应指纹
+    :return: 网页，不存在返回None
+    """
     try:
-        response = requests.get(url, timeout=UrlScan.timeout, verify=False, headers=headers)
-    except Exception:
+        async with session.get(url, headers=gen_fake_header(), ssl=False,
+                               timeout=TIMEOUT) as resp:
+            if resp.status not in UrlScan.success_status_code:
+                return None
+            if baseline is None or resp.status != baseline.status:
+                return await read_page(resp)
+            head = await read_body(resp.content, FINGERPRINT_SIZE)
+            if get_digest(head, url.rsplit('/', 1)[-1]) == baseline.digest:
+                return None
+            return await read_page(resp, head)
+    except Exception as e:
+        logger.log('DEBUG', f'url探测:请求{url}出错{e!r}')
         return None
-    else:
-        return response
+
+
+async def sub_path_main(session, url):
+    """
+    并发查找二级目录
+
+    同时请求的路径数不超过UrlScan.subdirectory_threads，找到UrlScan.subdirectory_hits个
+    或超过UrlScan.subdirectory_timeout后取消其余请求，获取不存在路径的响应指纹也计入查找时间
+
+    :param str url: 根目录url
+    :return: 找到的二级目录网页列表
+    """
+    url = url.rstrip('/')
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + UrlScan.subdirectory_timeout
+    try:
+        baseline = await asyncio.wait_for(get_fingerprint(session, url), UrlScan.subdirectory_timeout)
+    except asyncio.TimeoutError:
+        logger.log('DEBUG', f'url探测:{url}二级目录查找超时')
+        return []
+    semaphore = asyncio.Semaphore(UrlScan.subdirectory_threads)
+
+    async def check(path):
+        async with semaphore:
+            return await sub_chek(session, f'{url}/{path}', baseline)
+
+    sucess = []
+    pending = {asyncio.ensure_future(check(path)) for path in UrlScan.subdirectory_path}
+    try:
+        while pending and len(sucess) < UrlScan.subdirectory_hits:
+            remain = deadline - loop.time()
+            if remain <= 0:
+                logger.log('DEBUG', f'url探测:{url}二级目录查找超时')
+                break
+            done, pending = await asyncio.wait(pending, timeout=remain,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            sucess.extend(page for page in (task.result() for task in done) if page)
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
+    return sucess[:UrlScan.subdirectory_hits]
 
 
 if __name__ == '__main__':
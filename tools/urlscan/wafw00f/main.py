@@ -21,6 +21,7 @@ class WAFW00F(waftoolsengine):
     def __init__(self, target='www.example.com', debuglevel=0, path='/',
                  followredirect=True, extraheaders={}, proxies=None):
         self.attackres = None
+        self.rq = None  # 正常请求的响应，每个实例各自保存，可在多个线程中同时检测
         waftoolsengine.__init__(self, target, debuglevel, path, proxies, followredirect, extraheaders)
         self.knowledge = dict(generic=dict(found=False, reason=''), wafname=list())
 
@@ -142,7 +143,7 @@ class WAFW00F(waftoolsengine):
     def matchHeader(self, headermatch, attack=False):
         if attack:
             r = self.attackres
-        else: r = rq
+        else: r = self.rq
         if r is None:
             return
         header, match = headermatch
@@ -162,7 +163,7 @@ class WAFW00F(waftoolsengine):
     def matchStatus(self, statuscode, attack=True):
         if attack:
             r = self.attackres
-        else: r = rq
+        else: r = self.rq
         if r is None:
             return
         if r.status_code == statuscode:
@@ -175,7 +176,7 @@ class WAFW00F(waftoolsengine):
     def matchReason(self, reasoncode, attack=True):
         if attack:
             r = self.attackres
-        else: r = rq
+        else: r = self.rq
         if r is None:
             return
         # We may need to match multiline context in response body
@@ -186,7 +187,7 @@ class WAFW00F(waftoolsengine):
     def matchContent(self, regex, attack=True):
         if attack:
             r = self.attackres
-        else: r = rq
+        else: r = self.rq
         if r is None:
             return
         # We may need to match multiline context in response body
@@ -286,9 +287,8 @@ class RequestBlocked(Exception):
 
 def main(target):
     attacker = WAFW00F(target)
-    global rq
     try:
-        rq = attacker.normalRequest()
+        rq = attacker.rq = attacker.normalRequest()
     except Exception as e:
         logger.log('ALERT', f'waf检测：[{target}]访问出错{e}')
         return False, None
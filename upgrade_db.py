@@ -0,0 +1,51 @@
+# 已有数据库升级脚本，为旧版本创建的数据库补充新增的表、字段和索引，可重复执行
+# 使用方法: python upgrade_db.py
+
+from sqlalchemy import inspect
+
+from web import DB
+from web.models import SrcDomain, SrcSubDomain, SrcPorts, SrcUrls, ShodanCache
+from web.utils.logs import logger
+
+# 需要补充任务租约字段(LeaseMixin)的表
+LEASE_MODELS = [SrcDomain, SrcSubDomain, SrcPorts, SrcUrls]
+# 新增的表
+NEW_MODELS = [ShodanCache]
+
+
+def add_columns(model):
+    """
+    为已存在的表补充模型中新增的字段和索引，表不存在时直接建表
+
+    :param model: 数据库模型
+    """
+    table = model.__table__
+    engine = DB.engine
+    inspector = inspect(engine)
+    if table.name not in inspector.get_table_names():
+        table.create(engine)
+        logger.log('INFOR', f'新建表{table.name}')
+        return
+    exists = {column['name'] for column in inspector.get_columns(table.name)}
+    for column in table.columns:
+        if column.name in exists:
+            continue
+        column_type = column.type.compile(dialect=engine.dialect)
+        engine.execute(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+        logger.log('INFOR', f'表{table.name}新增字段{column.name}')
+    indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name in indexes:
+            continue
+        index.create(engine)
+        logger.log('INFOR', f'表{table.name}新增索引{index.name}')
+
+
+def upgrade():
+    for model in LEASE_MODELS + NEW_MODELS:
+        add_columns(model)
+    logger.log('INFOR', '数据库升级完成')
+
+
+if __name__ == '__main__':
+    upgrade()
@@ -63,7 +63,14 @@ class UserLogs(DB.Model):
         self.logs_text = logs_text
 
 
-class SrcDomain(DB.Model):
+class LeaseMixin(object):
+    """任务租约字段，由web.utils.workqueue领取任务时写入"""
+
+    lease_owner = DB.Column(DB.String(64), index=True)  # 领取任务的进程标识
+    lease_time = DB.Column(DB.DateTime)  # 领取任务的时间
+
+
+class SrcDomain(LeaseMixin, DB.Model):
     """主域名表"""
 
     __tablename__ = 'src_domain'
@@ -81,7 +88,7 @@ class SrcDomain(DB.Model):
         self.domain_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
-class SrcSubDomain(DB.Model):
+class SrcSubDomain(LeaseMixin, DB.Model):
     """子域名表"""
 
     __tablename__ = 'src_subdomain'
@@ -111,7 +118,7 @@ class SrcSubDomain(DB.Model):
         self.subdomain_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
-class SrcPorts(DB.Model):
+class SrcPorts(LeaseMixin, DB.Model):
     """端口扫描表"""
 
     __tablename__ = 'src_ports'
@@ -139,7 +146,7 @@ class SrcPorts(DB.Model):
         self.port_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
-class SrcUrls(DB.Model):
+class SrcUrls(LeaseMixin, DB.Model):
     """URL表"""
 
     __tablename__ = 'src_urls'
@@ -168,6 +175,22 @@ class SrcUrls(DB.Model):
         self.url_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
 
+class ShodanCache(DB.Model):
+    """Shodan查询缓存表"""
+
+    __tablename__ = 'src_shodan_cache'
+    ip = DB.Column(DB.String(50), primary_key=True)
+    ports = DB.Column(DB.Text)  # json格式端口列表
+    found = DB.Column(DB.Boolean)  # shodan是否有该IP的数据
+    query_time = DB.Column(DB.DateTime, index=True)
+
+    def __init__(self, ip, ports, found):
+        self.ip = ip
+        self.ports = ports
+        self.found = found
+        self.query_time = datetime.datetime.now()
+
+
 class SrcVulnerabilitie(DB.Model):
     """漏洞信息表"""
 
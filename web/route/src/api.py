@@ -5,6 +5,7 @@ from web import DB
 from web.utils.auxiliary import addlog
 from web.models import SrcDomain, SrcSubDomain, SrcPorts, SrcUrls, SrcVulnerabilitie
 from web.utils.logs import logger
+from web.utils.workqueue import notify, DOMAIN_CHANNEL, URL_CHANNEL
 
 class SrcDomainAPI(Resource):
     """src 主域名任务管理类"""
@@ -39,6 +40,7 @@ class SrcDomainAPI(Resource):
             logger.log('ALERT', '主域名添加任务接口SQL错误:%s' % e)
             DB.session.rollback()
             return {'result': {'status_code': 500}}
+        notify(DOMAIN_CHANNEL)
         addlog(session.get('username'), session.get('login_ip'), f'添加主域名任务成功，主域名为：{key_domain},厂商为:{key_domain_name}')
         logger.log('INFOR', f'添加主域名任务成功-主域名[{key_domain}]-厂商[{key_domain_name}]')
         return {'result': {'status_code': 200}}
@@ -146,6 +148,7 @@ class SrcDomainAPI(Resource):
             DB.session.rollback()
             logger.log('ALERT', f'再次扫描主任务失败,{e}')
             return {'result': {'status_code': 500}}
+        notify(DOMAIN_CHANNEL)
         addlog(session.get('username'), session.get('login_ip'), f'再次扫描主任务:[{key_domain}] 成功')
         logger.log('INFOR', f'再次扫描主任务成功，{key_domain}')
         return {'result': {'status_code': 200}}
@@ -379,6 +382,7 @@ class SrcUrlsAPI(Resource):
             DB.session.rollback()
             logger.log('ALERT', f'添加URL扫描任务失败,{e}')
             return {'result': {'status_code': 500}}
+        notify(URL_CHANNEL)
         addlog(session.get('username'), session.get('login_ip'), f'添加URL扫描任务成功')
         logger.log('INFOR', f'添加URL扫描任务成功')
         return {'result': {'status_code': 200}}
@@ -406,6 +410,7 @@ class SrcUrlsAPI(Resource):
             DB.session.rollback()
             logger.log('ALERT', f'批量添加URL任务失败,{e}')
             return {'result': {'status_code': 500}}
+        notify(URL_CHANNEL)
         addlog(session.get('username'), session.get('login_ip'), f'批量添加URL任务成功')
         logger.log('INFOR', f'批量添加URL任务成功')
         return {'result': {'status_code': 200}}
@@ -3,6 +3,7 @@
 from urllib.parse import *
 from flask import session, redirect, url_for
 from functools import wraps
+from sqlalchemy.dialects import mysql, postgresql
 
 from web import DB
 from web.utils.logs import logger
@@ -55,3 +56,46 @@ def scan_write(plugin, url, payload, raw, flag, scan_name):
     except Exception as e:
         DB.session.rollback()
         print('新增漏洞扫描结果失败; %s' % e)
+
+def bulk_insert_ignore(model, rows, chunk=500):
+    """
+    多行INSERT批量入库，主键冲突的行直接忽略
+
+    :param model: 表模型
+    :param list rows: 字典形式的行数据
+    :param int chunk: 每条INSERT语句的行数
+    :return: 实际写入的行数(MySQL下包含已存在而忽略的行)
+    """
+    dialect = DB.engine.dialect.name
+    if dialect == 'postgresql':
+        stmt = postgresql.insert(model.__table__).on_conflict_do_nothing()
+    elif dialect == 'mysql':
+        # 不用INSERT IGNORE，它会把数据截断等错误也变成警告，这里只忽略主键冲突
+        stmt = mysql.insert(model.__table__)
+        stmt = stmt.on_duplicate_key_update({column.name: column for column in model.__table__.primary_key})
+    elif dialect == 'sqlite':
+        stmt = model.__table__.insert().prefix_with('OR IGNORE')
+    else:
+        stmt = model.__table__.insert()
+    count = 0
+    for i in range(0, len(rows), chunk):
+        count += insert_chunk(model, stmt, rows[i:i + chunk])
+    return count
+
+def insert_chunk(model, stmt, rows):
+    """
+    一条INSERT写入一组行，失败时二分重试，只丢弃真正出错的行
+
+    :return: 实际写入的行数
+    """
+    try:
+        result = DB.session.execute(stmt.values(rows))
+        DB.session.commit()
+    except Exception as e:
+        DB.session.rollback()
+        if len(rows) == 1:
+            logger.log('ALERT', f'{model.__tablename__}入库SQL错误:{e}，数据:{rows[0]}')
+            return 0
+        middle = len(rows) // 2
+        return insert_chunk(model, stmt, rows[:middle]) + insert_chunk(model, stmt, rows[middle:])
+    return max(result.rowcount, 0)
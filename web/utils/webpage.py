@@ -0,0 +1,155 @@
+# 网页解析模块，供子域请求和url探测提取网页标题和识别响应编码
+
+import codecs
+import html
+import re
+
+import chardet
+from bs4 import BeautifulSoup
+
+TITLE_SCAN_SIZE = 32 * 1024  # 只在网页开头这么多字符内用正则查找标题
+CHARSET_SCAN_SIZE = 4 * 1024  # 在网页开头这么多字节内查找meta声明的编码
+CHARSET_SAMPLE_SIZE = 16 * 1024  # 自动识别编码时最多取样的字节数
+
+TITLE_REGEXP = re.compile(r'<title[^>]*>(.*?)</title>', re.I | re.S)
+HEADING_REGEXPS = [re.compile(rf'<h{level}[^>]*>(.*?)</h{level}>', re.I | re.S)
+                   for level in (1, 2, 3)]
+META_REGEXP = re.compile(r'<meta\b([^>]*)>', re.I)
+ATTR_REGEXP = re.compile(r'([\w-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s>]+))')
+TAG_REGEXP = re.compile(r'<[^>]+>')
+HEADER_CHARSET_REGEXP = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.I)
+META_CHARSET_REGEXP = re.compile(rb'<meta\b[^>]*?charset\s*=\s*["\']?([\w.:-]+)', re.I)
+
+
+def get_meta(markup, name):
+    """查找指定name的meta标签内容"""
+    for match in META_REGEXP.finditer(markup):
+        attrs = {}
+        for key, *values in ATTR_REGEXP.findall(match.group(1)):
+            attrs[key.lower()] = ''.join(values)
+        if attrs.get('name', '').lower() == name and 'content' in attrs:
+            return attrs['content']
+    return None
+
+
+def search_title(markup):
+    """
+    用正则按title、h1、h2、h3、description、keywords的顺序查找标题
+
+    :param str markup: 网页开头部分
+    :return: 标题，没有找到返回None
+    """
+    match = TITLE_REGEXP.search(markup)
+    if match:
+        return html.unescape(match.group(1)).strip()
+    for regexp in HEADING_REGEXPS:
+        match = regexp.search(markup)
+        if match:
+            return html.unescape(TAG_REGEXP.sub('', match.group(1))).strip()
+    for name in ('description', 'keywords'):
+        content = get_meta(markup, name)
+        if content is not None:
+            return html.unescape(content).strip()
+    return None
+
+
+def parse_title(markup):
+    """
+    完整解析网页查找标题，网页很短时取网页文本
+
+    :param str markup: 网页
+    :return: 标题，没有找到返回None
+    """
+    try:
+        soup = BeautifulSoup(markup, 'lxml')
+    except Exception:
+        return None
+    for tag in (soup.title, soup.h1, soup.h2, soup.h3):
+        if tag:
+            return tag.text.strip()
+    for name in ('description', 'keywords'):
+        meta = soup.find('meta', attrs={'name': name})
+        if meta and meta.get('content') is not None:
+            return meta['content'].strip()
+    text = soup.text
+    if len(text) <= 200:
+        return text.strip()
+    return None
+
+
+def get_title(markup, limit=TITLE_SCAN_SIZE):
+    """
+    获取网页标题
+
+    先在网页开头部分用预编译的正则查找，找不到时才完整解析整个网页
+
+    :param str markup: 网页
+    :param int limit: 正则查找的字符数
+    :return: 标题，没有找到返回None
+    """
+    if not markup:
+        return None
+    title = search_title(markup[:limit])
+    if title is None:
+        title = parse_title(markup)
+    return title
+
+
+def check_encoding(encoding):
+    """检查编码名称是否可用，可用时返回规范的编码名称"""
+    if not encoding:
+        return None
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return None
+
+
+def get_encoding(content, content_type=None):
+    """
+    识别响应体编码
+
+    依次使用Content-Type声明的编码、网页开头meta声明的编码、严格模式能解码的utf-8或gb18030，
+    都不可用时才对开头部分取样自动识别
+
+    :param bytes content: 响应体
+    :param str content_type: 响应头Content-Type
+    :return: 编码名称
+    """
+    if content_type:
+        match = HEADER_CHARSET_REGEXP.search(content_type)
+        encoding = check_encoding(match and match.group(1))
+        if encoding:
+            return encoding
+    match = META_CHARSET_REGEXP.search(content[:CHARSET_SCAN_SIZE])
+    encoding = check_encoding(match and match.group(1).decode('ascii', 'ignore'))
+    if encoding:
+        return encoding
+    for encoding in ('utf-8', 'gb18030'):
+        # 响应体可能被截断，用增量解码器忽略末尾不完整的字符
+        decoder = codecs.getincrementaldecoder(encoding)(errors='strict')
+        try:
+            decoder.decode(content, final=False)
+        except UnicodeError:
+            continue
+        return encoding
+    encoding = chardet.detect(content[:CHARSET_SAMPLE_SIZE])['encoding']
+    return check_encoding(encoding) or 'utf-8'
+
+
+async def read_body(content, size):
+    """
+    读取异步响应体的开头部分，单次read只返回已缓冲的数据，需要循环读取直到读够或读完
+
+    :param content: aiohttp响应的content流
+    :param int size: 最多读取的字节数
+    :return: 响应体开头部分
+    """
+    chunks = []
+    while size > 0:
+        chunk = await content.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
@@ -0,0 +1,229 @@
+# 任务队列模块，基于数据库任务表实现多进程原子领取任务、租约过期和新任务唤醒通知
+
+import datetime
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import redis
+from sqlalchemy import or_
+
+from config import WorkQueue
+from web import DB
+from web.utils.logs import logger
+
+# 通知频道，生产者写入新任务后发布通知，对应阶段的等待进程立即被唤醒
+DOMAIN_CHANNEL = 'bayonet:domain'  # 主域名任务 -> 子域名扫描
+SUBDOMAIN_CHANNEL = 'bayonet:subdomain'  # 子域名入库 -> 端口扫描
+PORT_CHANNEL = 'bayonet:port'  # 端口入库 -> url探测
+URL_CHANNEL = 'bayonet:url'  # url扫描任务 -> 爬虫
+
+_redis_client = None
+
+
+def get_redis():
+    """获取通知使用的redis连接，连接失败返回None"""
+    global _redis_client
+    if _redis_client is None:
+        try:
+            client = redis.Redis.from_url(WorkQueue.redis_url, socket_connect_timeout=3)
+            client.ping()
+        except Exception as e:
+            logger.log('ALERT', f'任务通知redis连接失败，使用定时轮询:{e}')
+            _redis_client = False
+        else:
+            _redis_client = client
+    return _redis_client or None
+
+
+def notify(channel):
+    """发布新任务通知，失败不影响任务写入"""
+    client = get_redis()
+    if not client:
+        return
+    try:
+        client.publish(channel, 1)
+    except Exception as e:
+        logger.log('DEBUG', f'发布任务通知[{channel}]失败:{e}')
+
+
+def supports_skip_locked():
+    """判断当前数据库是否支持SELECT ... FOR UPDATE SKIP LOCKED"""
+    dialect = DB.engine.dialect
+    if dialect.name == 'postgresql':
+        return True
+    if dialect.name == 'mysql':
+        version = dialect.server_version_info or ()
+        return not getattr(dialect, '_is_mariadb', False) and version >= (8, 0, 1)
+    return False
+
+
+class TaskQueue(object):
+    """
+    数据库任务表队列
+
+    :param model: 任务表模型，需继承LeaseMixin
+    :param list pending: 待处理任务的过滤条件
+    :param str channel: 新任务通知频道
+    :param int lease: 租约时长(秒)
+    """
+
+    def __init__(self, model, pending, channel, lease):
+        self.model = model
+        self.pending = pending
+        self.channel = channel
+        self.lease = lease
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.key = model.__mapper__.primary_key[0]
+        self.pubsub = None
+
+    def subscribe(self):
+        """订阅通知频道，先订阅再查询，避免查询期间的通知丢失"""
+        if self.pubsub is not None:
+            return
+        client = get_redis()
+        if not client:
+            return
+        try:
+            pubsub = client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(self.channel)
+        except Exception as e:
+            logger.log('ALERT', f'订阅任务通知[{self.channel}]失败:{e}')
+        else:
+            self.pubsub = pubsub
+
+    def claim(self, limit=1, **values):
+        """
+        原子领取任务
+
+        支持SKIP LOCKED的数据库跳过被其他进程锁定的行，其他数据库依靠带租约条件的UPDATE保证
+        同一任务只会被一个进程领取
+
+        :param int limit: 最多领取任务数
+        :param values: 领取时一并更新的字段
+        :return: 领取到的任务列表
+        """
+        self.subscribe()
+        # 带租约条件的UPDATE被其他进程抢先时还有待领取的任务，立即重新领取而不是空闲等待
+        for _ in range(WorkQueue.claim_retries):
+            now = datetime.datetime.now()
+            expired = now - datetime.timedelta(seconds=self.lease)
+            token = f'{self.owner}:{uuid.uuid4().hex[:12]}'
+            free = or_(self.model.lease_time.is_(None), self.model.lease_time < expired)
+            try:
+                query = DB.session.query(self.key).filter(*self.pending).filter(free)
+                if supports_skip_locked():
+                    query = query.with_for_update(skip_locked=True)
+                keys = [row[0] for row in query.limit(limit).all()]
+                updated = 0
+                if keys:
+                    values.update(lease_owner=token, lease_time=now)
+                    updated = self.model.query.filter(self.key.in_(keys), free)\
+                        .update(values, synchronize_session=False)
+                DB.session.commit()
+            except Exception as e:
+                DB.session.rollback()
+                logger.log('ALERT', f'领取{self.model.__tablename__}任务SQL错误:{e}')
+                return []
+            if not keys:
+                return []
+            if updated:
+                break
+        else:
+            return []
+        results = self.model.query.filter(self.model.lease_owner == token).all()
+        # 提交前移出会话，避免提交后对象过期，读取属性时逐行重新查询
+        for result in results:
+            DB.session.expunge(result)
+        DB.session.commit()
+        return results
+
+    def renew(self, results):
+        """续约任务，防止长时间运行的任务被其他进程重新领取"""
+        self.touch({result.lease_owner for result in results})
+
+    def touch(self, owners):
+        """按领取标识续约任务"""
+        try:
+            self.model.query.filter(self.model.lease_owner.in_(owners)) \
+                .update({'lease_time': datetime.datetime.now()}, synchronize_session=False)
+            DB.session.commit()
+        except Exception as e:
+            DB.session.rollback()
+            logger.log('ALERT', f'续约{self.model.__tablename__}任务SQL错误:{e}')
+
+    @contextmanager
+    def keepalive(self, results):
+        """任务执行期间后台定时续约"""
+        owners = {result.lease_owner for result in results}
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.lease / 3):
+                self.touch(owners)
+            DB.session.remove()
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def done(self, results, **values):
+        """
+        完成任务，更新字段并释放租约
+
+        只更新租约仍属于本进程的任务，租约过期后被其他进程重新领取的任务不会被改动
+
+        :param list results: 任务列表
+        :param values: 需要更新的字段
+        """
+        keys = [getattr(result, self.key.key) for result in results]
+        if not keys:
+            return
+        owners = list({result.lease_owner for result in results})
+        values.update(lease_owner=None, lease_time=None)
+        try:
+            count = self.model.query.filter(self.key.in_(keys), self.model.lease_owner.in_(owners))\
+                .update(values, synchronize_session=False)
+            DB.session.commit()
+            if count < len(keys):
+                logger.log('ALERT', f'{self.model.__tablename__}有{len(keys) - count}个任务租约已失效，'
+                                    f'由其他进程重新领取')
+        except Exception as e:
+            DB.session.rollback()
+            logger.log('ALERT', f'更新{self.model.__tablename__}任务状态SQL错误:{e}')
+
+    def wait(self, timeout=None):
+        """
+        没有任务时等待，收到新任务通知立即返回
+
+        :param int timeout: 最长等待时间(秒)
+        :return: 是否收到通知
+        """
+        timeout = timeout or WorkQueue.idle_timeout
+        if self.pubsub is None:
+            time.sleep(timeout)
+            return False
+        deadline = time.time() + timeout
+        while True:
+            remain = deadline - time.time()
+            if remain <= 0:
+                return False
+            try:
+                message = self.pubsub.get_message(timeout=remain)
+            except Exception as e:
+                logger.log('ALERT', f'接收任务通知[{self.channel}]失败:{e}')
+                self.pubsub = None
+                time.sleep(max(deadline - time.time(), 0))
+                return False
+            if message:
+                # 合并等待期间积压的通知，避免重复唤醒
+                while self.pubsub.get_message():
+                    pass
+                return True